@@ -3,6 +3,8 @@
 classdef AnalysisClient < handle
     properties
         client;
+        % set by set_roi, every roi comes back as its own block
+        split_blocks = false;
     end
 
     methods(Access = private)
@@ -19,6 +21,14 @@ classdef AnalysisClient < handle
         end
     end
     methods(Static)
+        function pyrois = roi_list(rois)
+            % [x0 x1 y0 y1] rows, 1-based and inclusive, to the python rois
+            pyrois = py.list();
+            for i = 1:size(rois, 1)
+                pyrois.append(py.list({int64(rois(i, 1) - 1), int64(rois(i, 2)), ...
+                                       int64(rois(i, 3) - 1), int64(rois(i, 4))}));
+            end
+        end
         function info = process_imgs(double_arr)
             % we traverse through the double array and separate out the
             % imgs per sequence and return a cell array, where each entry
@@ -88,6 +98,54 @@ classdef AnalysisClient < handle
             info.scan_ids = scan_ids;
             info.seq_ids = seq_ids;
         end
+        function info = process_seqs(seqs, native, split_blocks)
+            % same as process_imgs but for the decoded typed format
+            % (get_typed_imgs, get_imgs_multipart), where seqs is a list of
+            % ImgFormat.SeqImgs. Pixels are converted to double like
+            % process_imgs unless native is true, in which case they keep
+            % the class they were stored with.
+            % With split_blocks (rois set) the blocks aren't stacked,
+            % info.imgs{seq} is then a cell array with one entry per block.
+            if ~exist('native', 'var')
+                native = false;
+            end
+            if ~exist('split_blocks', 'var')
+                split_blocks = false;
+            end
+            seqs = cell(seqs);
+            num_seqs = length(seqs);
+            imgs = cell(1, num_seqs);
+            scan_ids = zeros(1, num_seqs);
+            seq_ids = zeros(1, num_seqs);
+            for seq_idx = 1:num_seqs
+                seq = seqs{seq_idx};
+                scan_ids(seq_idx) = double(seq.scan_id);
+                seq_ids(seq_idx) = double(seq.seq_id);
+                blocks = cell(seq.blocks);
+                if split_blocks
+                    imgs{seq_idx} = cell(1, length(blocks));
+                end
+                for i = 1:length(blocks)
+                    block = blocks{i};
+                    shape = cellfun(@double, cell(block.shape));
+                    if native
+                        data = feval(char(block.dtype_name), py.ImgFormat.to_array(block.data));
+                    else
+                        data = double(py.ImgFormat.to_array(block.data));
+                    end
+                    if split_blocks
+                        imgs{seq_idx}{i} = reshape(data, shape);
+                    else
+                        % assumes all images in one sequence are same size for
+                        % now...
+                        imgs{seq_idx} = cat(3, imgs{seq_idx}, reshape(data, shape));
+                    end
+                end
+            end
+            info.imgs = imgs;
+            info.scan_ids = scan_ids;
+            info.seq_ids = seq_ids;
+        end
     end
     methods
         function res = pause_seq(self)
@@ -106,20 +164,114 @@ classdef AnalysisClient < handle
             res = cell(self.client.get_status());
             res = char(res{1});
         end
+        function [status, dropped] = get_status_dropped(self)
+            % status and '<n> sequences dropped' of the image queue
+            res = cell(self.client.get_status_dropped());
+            status = char(res{1});
+            dropped = char(res{2});
+        end
         function [info] = get_imgs(self)
-            res = double(self.client.get_imgs(10000)); % timeout of 10 s
+            if self.split_blocks
+                % process_imgs would stack the rois
+                res = self.client.get_img_records(10000); % timeout of 10 s
+                if res == py.None
+                    res = py.list();
+                end
+                info = AnalysisClient.process_seqs(res, false, true);
+                return
+            end
+            res = self.client.get_imgs(10000); % timeout of 10 s
+            if res == py.None
+                res = 0;
+            else
+                res = double(py.ImgFormat.to_array(res));
+            end
             info = AnalysisClient.process_imgs(res);
         end
+        function [info] = get_typed_imgs(self, native)
+            % native: keep the stored pixel class instead of double
+            if ~exist('native', 'var')
+                native = false;
+            end
+            res = self.client.get_typed_imgs(10000); % timeout of 10 s
+            if res == py.None
+                res = py.list();
+            end
+            info = AnalysisClient.process_seqs(res, native, self.split_blocks);
+        end
+        function [info] = get_imgs_multipart(self, native)
+            if ~exist('native', 'var')
+                native = false;
+            end
+            res = self.client.get_imgs_multipart(10000); % timeout of 10 s
+            if res == py.None
+                res = py.list();
+            end
+            info = AnalysisClient.process_seqs(res, native, self.split_blocks);
+        end
         function res = get_seq_num(self)
             res = double(self.client.get_seq_num());
         end
         function res = get_num_imgs(self)
             res = double(self.client.get_num_imgs());
         end
+        function [nimgs, ndropped] = get_num_imgs_dropped(self)
+            res = self.client.get_num_imgs_dropped();
+            if res == py.None
+                nimgs = NaN;
+                ndropped = NaN;
+                return
+            end
+            res = cell(res);
+            nimgs = double(res{1});
+            ndropped = double(res{2});
+        end
+        function res = get_stats(self)
+            res = self.client.get_stats();
+            if res == py.None
+                res = struct();
+                return
+            end
+            res = jsondecode(char(py.json.dumps(res)));
+        end
         function res = get_config(self)
             res = cell(self.client.get_config());
             res = cellfun(@char, res, 'UniformOutput', false);
         end
+        function set_compression(self, method, level)
+            % method is 'zlib', 'lzma' or '' for no compression
+            if ~exist('level', 'var')
+                level = 1;
+            end
+            self.client.set_compression(method, int64(level));
+        end
+        function res = get_compress_stats(self)
+            % decompression of the images received by this client
+            res = jsondecode(char(py.json.dumps(self.client.get_compress_stats())));
+        end
+        function res = get_server_compress_stats(self)
+            % compression of the images sent by the server
+            res = cell(self.client.get_server_compress_stats());
+            if res{1} == py.None
+                res = struct();
+                return
+            end
+            res = jsondecode(char(res{1}));
+        end
+        function res = set_roi(self, rois, binning)
+            % have the server crop the images to rois, one [x0 x1 y0 y1]
+            % row per roi (1-based, inclusive), and bin them binning x binning.
+            % Each roi comes back as its own block, so get_typed_imgs and
+            % get_imgs_multipart return a cell array of images per sequence.
+            % set_roi([]) for full frames.
+            if ~exist('binning', 'var')
+                binning = 1;
+            end
+            self.split_blocks = ~isempty(rois);
+            pyrois = AnalysisClient.roi_list(rois);
+            res = cell(self.client.set_roi(int64(1000), pyargs('rois', pyrois, 'binning', int64(binning))));
+            res = char(res{1});
+        end
         function recreate_sock(self)
             self.client.recreate_sock();
         end
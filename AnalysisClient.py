@@ -1,7 +1,8 @@
 import zmq
-import array
+import json
+import ImgFormat
 
-class AnalysisClient(object):
+class AnalysisClient(ImgFormat.ImgRequestOpts):
     def recreate_sock(self):
         if self.__sock is not None:
             self.__sock.close()
@@ -15,6 +16,54 @@ class AnalysisClient(object):
         self.__sock = None
         self.recreate_sock()
         self.timeout = 500
+        self.__sub_sock = None
+        # compression requested for images and rois, see ImgFormat.ImgRequestOpts
+        self.init_img_opts()
+
+    def close(self):
+        # unsent requests are dropped
+        if self.__sub_sock is not None:
+            self.__sub_sock.close()
+            self.__sub_sock = None
+        self.__sock.close()
+        self.__ctx.destroy(linger=0)
+
+    def subscribe(self, sub_url):
+        # receive finished sequences pushed by the ExptServer PUB socket at sub_url.
+        # An empty sub_url unsubscribes.
+        if self.__sub_sock is not None:
+            self.__sub_sock.close()
+            self.__sub_sock = None
+        if sub_url:
+            self.__sub_sock = self.__ctx.socket(zmq.SUB)
+            self.__sub_sock.setsockopt(zmq.LINGER, 0)
+            self.__sub_sock.setsockopt(zmq.SUBSCRIBE, b'seq')
+            self.__sub_sock.connect(sub_url)
+
+    def __send_legacy_request(self):
+        # legacy image request, with the rois/binning if there are any
+        if not self.view_opts:
+            self.__sock.send_string("get_imgs")
+            return
+        self.__sock.send_string("get_imgs", zmq.SNDMORE)
+        self.__sock.send(json.dumps(self.view_opts).encode())
+
+    def is_subscribed(self) -> bool:
+        return self.__sub_sock is not None
+
+    def recv_published(self, timeout=1000):
+        # returns a list of all the SeqImgs published so far, waiting up to timeout ms for the first one,
+        # or None if nothing arrived
+        if self.__sub_sock is None or self.__sub_sock.poll(timeout) == 0:
+            return None
+        seqs = []
+        while True:
+            try:
+                frames = self.__sub_sock.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            seqs.extend(ImgFormat.decode(frames[1:]))
+        return seqs
 
     # decorators for polling
     def poll_recv(func):
@@ -30,14 +79,41 @@ class AnalysisClient(object):
             return rep
         return f
 
-    def poll_recv_string(func):
-        def f(self, timeout=1000, flag=0): #timeout in milliseconds
+    def poll_recv_frame(func):
+        # like poll_recv but returns the zmq.Frame so that the data can be used without copying
+        def f(self, timeout=1000, flag=0):
             try:
                 func(self)
             except:
                 pass
             if self.__sock.poll(timeout) == 0:
                 rep = None
+            else:
+                rep = self.__sock.recv(flag, copy=False)
+            return rep
+        return f
+
+    def poll_recv_multipart(func):
+        def f(self, timeout=1000, **kwargs):
+            try:
+                func(self, **kwargs)
+            except:
+                pass
+            if self.__sock.poll(timeout) == 0:
+                rep = None
+            else:
+                rep = self.__sock.recv_multipart(copy=False)
+            return rep
+        return f
+
+    def poll_recv_string(func):
+        def f(self, timeout=1000, flag=0, **kwargs): #timeout in milliseconds
+            try:
+                func(self, **kwargs)
+            except:
+                pass
+            if self.__sock.poll(timeout) == 0:
+                rep = None
             else:
                 rep = self.__sock.recv_string(flag)
             return [rep]
@@ -45,14 +121,59 @@ class AnalysisClient(object):
 
     # decorators for poll_recv
     def convert_to_array(func):
+        # float64 view of the received message, without copying it
         def f(self, *args, **kwargs):
             rep = func(self, *args, **kwargs)
             data = None
             if rep is not None:
-                data = array.array('d', rep)
+                data = ImgFormat.as_bytes(getattr(rep, 'buffer', rep)).cast('d')
             return data
         return f
 
+    def parse_legacy(func):
+        # split the legacy float64 stream into a list of SeqImgs, use SeqImgs.to_tuple to get
+        # (scan_id, seq_id, ndarray[nx, ny, nimgs])
+        def f(self, *args, **kwargs):
+            rep = func(self, *args, **kwargs)
+            if rep is None:
+                return None
+            return ImgFormat.decode_legacy(rep)
+        return f
+
+    def decode_imgs(func):
+        # decode a typed image reply (single buffer or multipart) into a list of ImgFormat.SeqImgs.
+        # The pixel data of each block is a memoryview into the received message.
+        def f(self, *args, **kwargs):
+            rep = func(self, *args, **kwargs)
+            if rep is None:
+                return None
+            return ImgFormat.decode(rep, self.compress_stats)
+        return f
+
+    def decode_img_chunk(func):
+        # like decode_imgs but returns [more, seqs], more is True if the server has more sequences queued
+        def f(self, *args, **kwargs):
+            rep = func(self, *args, **kwargs)
+            if rep is None:
+                return None
+            flags, seqs = ImgFormat.decode_stream(rep, self.compress_stats)
+            return [bool(flags & ImgFormat.FLAG_MORE), seqs]
+        return f
+
+    def decode_since(func):
+        # decode the reply of get_imgs_since into [next index, first retained index, more, seqs, reset].
+        # reset is set if the index was past the end of the log, e.g. after the server restarted,
+        # seqs then start at first again.
+        def f(self, *args, **kwargs):
+            rep = func(self, *args, **kwargs)
+            if rep is None:
+                return None
+            info = json.loads(rep[0].bytes)
+            flags, seqs = ImgFormat.decode_stream(rep[1:], self.compress_stats)
+            return [info['next'], info['first'], bool(flags & ImgFormat.FLAG_MORE), seqs,
+                    info.get('reset', False)]
+        return f
+
     def convert_to_int(func):
         def f(self, *args, **kwargs):
             rep = func(self, *args, **kwargs)
@@ -62,6 +183,15 @@ class AnalysisClient(object):
             return data
         return f
 
+    def convert_from_json(func):
+        def f(self, *args, **kwargs):
+            rep = func(self, *args, **kwargs)
+            data = None
+            if rep[0] is not None:
+                data = json.loads(rep[0])
+            return data
+        return f
+
     def recv_more_string(func):
         def f(self, *args, **kwargs):
             rep = func(self, *args, **kwargs)
@@ -75,6 +205,19 @@ class AnalysisClient(object):
             return data
         return f
 
+    def recv_more_int(func):
+        def f(self, *args, **kwargs):
+            rep = func(self, *args, **kwargs)
+            data = None
+            if rep is not None:
+                try:
+                    new_rep = int.from_bytes(self.__sock.recv(zmq.NOBLOCK), 'little')
+                except:
+                    new_rep = 0
+                data = [rep, new_rep]
+            return data
+        return f
+
     @poll_recv_string
     def pause_seq(self):
         self.__sock.send_string("pause_seq")
@@ -92,9 +235,52 @@ class AnalysisClient(object):
         self.__sock.send_string("get_status")
 
     @convert_to_array
-    @poll_recv
+    @poll_recv_frame
     def get_imgs(self):
-        self.__sock.send_string("get_imgs")
+        self.__send_legacy_request()
+
+    @parse_legacy
+    @poll_recv_frame
+    def get_img_records(self):
+        self.__send_legacy_request()
+
+    @decode_imgs
+    @poll_recv
+    def get_typed_imgs(self):
+        self.__sock.send_string("get_imgs", zmq.SNDMORE)
+        self.__sock.send(json.dumps(self.img_opts()).encode())
+
+    @decode_imgs
+    @poll_recv_multipart
+    def get_imgs_multipart(self):
+        self.__sock.send_string("get_imgs_multipart", zmq.SNDMORE)
+        self.__sock.send(json.dumps(self.img_opts()).encode())
+
+    @decode_img_chunk
+    @poll_recv_multipart
+    def get_imgs_chunk(self, max_seqs=16, max_bytes=64 * 1024 * 1024):
+        # fetch at most max_seqs sequences/max_bytes bytes of images (at least one sequence)
+        self.__sock.send_string("get_imgs_multipart", zmq.SNDMORE)
+        self.__sock.send(json.dumps(self.img_opts(max_seqs=max_seqs, max_bytes=max_bytes)).encode())
+
+    def iter_imgs(self, timeout=10000, max_seqs=16, max_bytes=64 * 1024 * 1024):
+        # fetch the whole backlog as a stream of bounded chunks, yielding a list of SeqImgs per chunk
+        more = True
+        while more:
+            rep = self.get_imgs_chunk(timeout, max_seqs=max_seqs, max_bytes=max_bytes)
+            if rep is None:
+                return
+            more, seqs = rep
+            yield seqs
+
+    @decode_since
+    @poll_recv_multipart
+    def get_imgs_since(self, index=0, max_seqs=16, max_bytes=64 * 1024 * 1024):
+        # non-destructive read of the server's image log starting at index.
+        # Other clients reading the log are not affected.
+        self.__sock.send_string("get_imgs_since", zmq.SNDMORE)
+        opts = self.img_opts(index=index, max_seqs=max_seqs, max_bytes=max_bytes)
+        self.__sock.send(json.dumps(opts).encode())
 
     @convert_to_int
     @poll_recv
@@ -106,6 +292,57 @@ class AnalysisClient(object):
     def get_num_imgs(self):
         self.__sock.send_string("get_num_imgs")
 
+    @recv_more_int
+    @convert_to_int
+    @poll_recv
+    def get_num_imgs_dropped(self):
+        # returns [number of sequences queued, number of sequences dropped]
+        self.__sock.send_string("get_num_imgs", zmq.SNDMORE)
+        self.__sock.send(json.dumps({'dropped': True}).encode())
+
+    def wait_status_change(self, last_status, timeout=5):
+        # long poll: the server replies once its status differs from last_status or after timeout seconds
+        try:
+            self.__sock.send_string("wait_status_change", zmq.SNDMORE)
+            self.__sock.send(json.dumps({'last': last_status, 'timeout': timeout}).encode())
+        except:
+            pass
+        # leave some time for the reply to arrive after the server side timeout
+        if self.__sock.poll(timeout * 1000 + 1000) == 0:
+            rep = None
+        else:
+            rep = self.__sock.recv_string()
+        return [rep]
+
+    @poll_recv_string
+    def set_roi(self, rois=None, binning=1):
+        # have the server crop all the images we fetch to rois ([x0, x1, y0, y1], 0-based with the end
+        # excluded, each becomes its own block) and bin them by binning. No rois and binning 1 for full frames.
+        # A single request can also pass 'roi' and 'bin' in img_opts instead. Call with keyword arguments.
+        # They are also sent with every image request, so they still apply if the reply is lost.
+        self.__sock.send_string("set_roi", zmq.SNDMORE)
+        self.__sock.send(json.dumps(self.set_view_opts(rois, binning)).encode())
+
+    @recv_more_string
+    @poll_recv_string
+    def get_status_dropped(self):
+        # returns [status, number of sequences dropped]
+        self.__sock.send_string("get_status", zmq.SNDMORE)
+        self.__sock.send(json.dumps({'dropped': True}).encode())
+
+    @convert_from_json
+    @poll_recv_string
+    def get_stats(self):
+        # dict with the queue depth, bytes sent, request counts, handle_msg latency percentiles
+        # and lock wait times of the server
+        self.__sock.send_string("get_stats")
+
+    @poll_recv_string
+    def get_server_compress_stats(self):
+        # json string with the compression ratio and CPU time on the server side.
+        # get_compress_stats (see ImgFormat.CompressOpts) has the decompression on our side.
+        self.__sock.send_string("get_compress_stats")
+
     @recv_more_string
     @poll_recv_string
     def get_config(self):
@@ -3,19 +3,30 @@
 classdef AnalysisServer < handle
     properties
         server;
+        % '' for a single REQ/REP client, 'stream' for the pipelined streaming transport with credit
+        % based flow control or 'router' for any number of clients of either kind at once
+        transport;
     end
 
     methods(Access = private)
-        function self = AnalysisServer(url)
+        function self = AnalysisServer(url, transport)
             [path, ~, ~] = fileparts(mfilename('fullpath'));
             pyglob = py.dict(pyargs('mat_srcpath', path, 'url', url));
             try
-                py.exec('from AnalysisServer import AnalysisServer', pyglob);
+                py.exec('from AnalysisServer import AnalysisServer, AnalysisStreamServer, AnalysisRouterServer', pyglob);
             catch
                 py.exec('import sys; sys.path.append(mat_srcpath)', pyglob);
-                py.exec('from AnalysisServer import AnalysisServer', pyglob);
+                py.exec('from AnalysisServer import AnalysisServer, AnalysisStreamServer, AnalysisRouterServer', pyglob);
+            end
+            self.transport = transport;
+            switch transport
+                case 'stream'
+                    self.server = py.eval('AnalysisStreamServer(url)', pyglob);
+                case 'router'
+                    self.server = py.eval('AnalysisRouterServer(url)', pyglob);
+                otherwise
+                    self.server = py.eval('AnalysisServer(url)', pyglob);
             end
-            self.server = py.eval('AnalysisServer(url)', pyglob);
         end
     end
 
@@ -46,8 +57,8 @@ classdef AnalysisServer < handle
                 data = self.server.recv_imgs();
                 if data ~= py.None
                     cleanup.disable();
-                    shape = double(data{1});
-                    img1D = double(data{2});
+                    shape = double(py.ImgFormat.to_array(data{1}));
+                    img1D = double(py.ImgFormat.to_array(data{2}));
                     imgs = reshape(img1D, shape(1), shape(2), shape(3));
                     return
                 end
@@ -76,11 +87,53 @@ classdef AnalysisServer < handle
                 end
             end
         end
-        function res = send_go(self)
-            res = self.server.send_go();
+        function res = send_go(self, client)
+            if exist('client', 'var')
+                res = self.server.send_go(client);
+            else
+                res = self.server.send_go();
+            end
+        end
+        function res = send_stop(self, client)
+            if exist('client', 'var')
+                res = self.server.send_stop(client);
+            else
+                res = self.server.send_stop();
+            end
+        end
+        function msg = recv_msg(self, client)
+            % router only, next message from any client or from client.
+            % msg.client, msg.cmd and msg.data, which is the images,
+            % {dateStamp, timeStamp} for config or the end_seq number.
+            cleanup = register_cleanup(self);
+            while 1
+                if exist('client', 'var')
+                    res = self.server.recv_msg(client);
+                else
+                    res = self.server.recv_msg();
+                end
+                if res ~= py.None
+                    cleanup.disable();
+                    break
+                end
+            end
+            msg.client = char(res{1});
+            msg.cmd = char(res{2});
+            data = res{3};
+            switch msg.cmd
+                case 'images'
+                    shape = double(py.ImgFormat.to_array(data{1}));
+                    msg.data = reshape(double(py.ImgFormat.to_array(data{2})), shape(1), shape(2), shape(3));
+                case 'config'
+                    msg.data = {char(data{1}), char(data{2})};
+                case 'end_seq'
+                    msg.data = double(data);
+                otherwise
+                    msg.data = [];
+            end
         end
-        function res = send_stop(self)
-            res = self.server.send_stop();
+        function res = get_clients(self)
+            res = cellfun(@char, cell(self.server.get_clients()), 'UniformOutput', false);
         end
         function recreate_sock(self)
             self.server.recreate_sock();
@@ -97,15 +150,28 @@ classdef AnalysisServer < handle
         function dropAll()
             remove(AnalysisServer.cache, keys(AnalysisServer.cache));
         end
-        function res = get(url)
+        function res = get(url, transport)
+            % transport is '' (default), 'stream' or 'router', see the
+            % transport property. Streaming clients need 'stream' or 'router'.
+            if ~exist('transport', 'var')
+                transport = '';
+            elseif islogical(transport) || isnumeric(transport)
+                transport = ifelse(transport, 'stream', '');
+            end
             cache = AnalysisServer.cache;
             if isKey(cache, url)
                 res = cache(url);
                 if ~isempty(res) && isvalid(res)
-                    return;
+                    if strcmp(res.transport, transport)
+                        return;
+                    end
+                    % the url can only be bound once, release it before
+                    % switching to the other transport
+                    res.server.close();
+                    delete(res);
                 end
             end
-            res = AnalysisServer(url);
+            res = AnalysisServer(url, transport);
             cache(url) = res;
         end
     end
@@ -1,5 +1,57 @@
 import zmq
 import array
+import json
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import ImgFormat
+
+def parse_imgs(frames, stats=None):
+    # [shape, imgdata] from the frames of an "images" message following the command.
+    # The frames are cast in place instead of being copied into new arrays.
+    shape = ImgFormat.as_bytes(frames[0].buffer).cast('d')
+    imgdata = frames[1].buffer
+    typecode = 'd'
+    if len(frames) > 2:
+        # compressed images
+        info = json.loads(frames[2].bytes)
+        typecode = ImgFormat.dtypes[info['dtype']][0]
+        imgdata = ImgFormat.decompress(imgdata, info['compress'], array.array(typecode).itemsize, stats)
+    return [shape, ImgFormat.as_bytes(imgdata).cast(typecode)]
+
+class Credits(object):
+    # credit accounting of one streaming client. The client says hello when it connects and again
+    # when it ran out of credit without hearing from us. Messages on a connection arrive in order, so
+    # by then everything it sent before the hello has arrived, and whatever we granted beyond the
+    # messages taken is either still on its way to the client or comes back when the queued messages
+    # are taken. A hello only tops that up to window.
+    # Every socket of the client has its own session token. Credit granted to an earlier socket is
+    # lost with it, so a hello with a new token starts the count over.
+    def __init__(self, window):
+        self.window = window
+        self.token = None
+        self.granted = 0
+        self.taken = 0
+    def hello(self, token=b'') -> int:
+        # credits to send for a hello
+        if token != self.token:
+            self.token = token
+            self.granted = 0
+            self.taken = 0
+        n = max(self.window - (self.granted - self.taken), 0)
+        self.granted += n
+        return n
+    def take(self) -> int:
+        # credit handed back for a message taken off the stream
+        self.taken += 1
+        self.granted += 1
+        return 1
+
+def hello_token(frames) -> bytes:
+    # session token of a hello, [b"hello", token]
+    if len(frames) < 2:
+        return b''
+    return frames[1].bytes
 
 class AnalysisServer(object):
     def recreate_sock(self):
@@ -13,7 +65,12 @@ class AnalysisServer(object):
         self.__ctx = zmq.Context()
         self.__sock = None
         self.recreate_sock()
+        self.compress_stats = ImgFormat.CompressStats()
     def __del__(self):
+        self.close()
+    def close(self):
+        if self.__ctx.closed:
+            return
         self.__sock.close()
         self.__ctx.destroy()
     def recv_info(self):
@@ -25,9 +82,12 @@ class AnalysisServer(object):
         timeout = 1 * 1000 # in milliseconds
         if self.__sock.poll(timeout) == 0:
             return
-        shape = array.array('d', self.__sock.recv())
-        imgdata = array.array('d', self.__sock.recv())
-        return [shape, imgdata]
+        return parse_imgs(self.__sock.recv_multipart(copy=False), self.compress_stats)
+    def recv_img_array(self):
+        # same as recv_imgs but returns the images as a (shape_x, shape_y, nimgs) numpy array
+        return ImgFormat.img_array(self.recv_imgs())
+    def get_compress_stats(self):
+        return self.compress_stats.to_dict()
     def recv_config(self):
         timeout = 1 * 1000 # in milliseconds
         if self.__sock.poll(timeout) == 0:
@@ -47,3 +107,250 @@ class AnalysisServer(object):
         return self.__sock.send(int(1).to_bytes(1, byteorder = 'little'))
     def send_stop(self):
         return self.__sock.send(int(0).to_bytes(1, byteorder = 'little'))
+
+class AnalysisStreamServer(object):
+    # Streaming version of AnalysisServer for ExptClient.ExptStreamClient, with the same receiving
+    # interface: recv_info returns the command of the next message and recv_imgs/recv_config/recv_end_seq
+    # its content. The client can have up to window messages in flight, one credit is handed back
+    # for every message taken off the stream so the client never runs ahead of us by more than that.
+    def recreate_sock(self):
+        if self.__sock is not None:
+            self.__sock.close()
+        self.__sock = self.__ctx.socket(zmq.DEALER)
+        self.__sock.setsockopt(zmq.LINGER, 0)
+        self.__sock.bind(self.__url)
+        self.__msg = None
+        self.__credits = Credits(self.window)
+    def __init__(self, url, window=16):
+        self.__url = url
+        self.__ctx = zmq.Context()
+        self.__sock = None
+        self.window = window
+        self.recreate_sock()
+        self.compress_stats = ImgFormat.CompressStats()
+    def __del__(self):
+        self.close()
+    def close(self):
+        if self.__ctx.closed:
+            return
+        self.__sock.close()
+        self.__ctx.destroy()
+    def __send_credit(self, n):
+        self.__sock.send_multipart([b"credit", n.to_bytes(4, byteorder = 'little')])
+    def recv_info(self):
+        timeout = 1 * 1000 # in milliseconds
+        while self.__sock.poll(timeout):
+            msg = self.__sock.recv_multipart(copy=False)
+            cmd = msg[0].bytes.decode()
+            if cmd == "hello":
+                # new (or reconnected) client, or one that ran out of credit
+                n = self.__credits.hello(hello_token(msg))
+                if n > 0:
+                    self.__send_credit(n)
+                timeout = 0
+                continue
+            self.__msg = msg[1:]
+            self.__send_credit(self.__credits.take())
+            return cmd
+        return
+    def recv_imgs(self):
+        return parse_imgs(self.__msg, self.compress_stats)
+    def recv_img_array(self):
+        return ImgFormat.img_array(self.recv_imgs())
+    def get_compress_stats(self):
+        return self.compress_stats.to_dict()
+    def recv_config(self):
+        return [self.__msg[0].bytes.decode(), self.__msg[1].bytes.decode()]
+    def recv_end_seq(self):
+        return int.from_bytes(self.__msg[0].bytes, byteorder = 'little')
+    def send_go(self):
+        return self.__sock.send(b"go")
+    def send_stop(self):
+        return self.__sock.send(b"stop")
+
+class AnalysisRouterServer(object):
+    # AnalysisServer for several experiment clients at once. A ROUTER socket keeps a session for
+    # every client, either an ExptClient (REQ) or an ExptStreamClient, and the images are decoded in
+    # a small thread pool so that a large or compressed message from one client doesn't hold up the others.
+    # recv_msg hands out the messages of each client in order, interleaved with the other clients
+    # in order of arrival. A REQ client gets its go/stop reply and a streaming client its credit back
+    # once its message is taken.
+    class Session(object):
+        def __init__(self, ident: bytes, req: bool):
+            self.ident = ident
+            self.client = ident.hex()
+            self.req = req # waits for a reply to every message
+            self.config = None # [dateStamp, timeStamp]
+            self.seq = None # last end_seq
+            self.nimgs = 0
+            self.stopped = False
+            self.credits = None # Credits of a streaming client
+
+    def __init__(self, url, window=16, nworkers=2):
+        self.__url = url
+        self.__ctx = zmq.Context()
+        self.window = window
+        self.max_batch = 64
+        self.compress_stats = ImgFormat.CompressStats()
+        self.__pool = ThreadPoolExecutor(nworkers)
+        self.__sessions = {} # client -> Session, only changed by the io thread
+        self.__cond = threading.Condition()
+        self.__msgs = deque() # (session, cmd, data or future of the data), oldest first
+        self.__outbox = deque() # frames to send, queued by the consumer for the io thread
+        # __ctrl_send is only used by the consumer, __ctrl_recv only by the io thread
+        ctrl_url = f'inproc://AnalysisRouterServer-ctrl-{id(self):x}'
+        self.__ctrl_recv = self.__ctx.socket(zmq.PAIR)
+        self.__ctrl_recv.bind(ctrl_url)
+        self.__ctrl_send = self.__ctx.socket(zmq.PAIR)
+        self.__ctrl_send.connect(ctrl_url)
+        self.__sock = None
+        self.__stop = False
+        self.__worker = None
+        self.recreate_sock()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.__ctx.closed:
+            return
+        self.stop_worker()
+        self.__pool.shutdown(wait=False)
+        self.__ctrl_send.close()
+        self.__ctrl_recv.close()
+        self.__ctx.destroy()
+
+    def recreate_sock(self):
+        self.stop_worker()
+        if self.__sock is not None:
+            self.__sock.close()
+        self.__sock = self.__ctx.socket(zmq.ROUTER)
+        self.__sock.setsockopt(zmq.LINGER, 0)
+        self.__sock.bind(self.__url)
+        self.__sessions = {}
+        with self.__cond:
+            self.__msgs = deque()
+        self.start_worker()
+
+    def stop_worker(self):
+        if self.__worker is None or not self.__worker.is_alive():
+            return
+        self.__stop = True
+        self.__ctrl_send.send(b'')
+        self.__worker.join()
+
+    def start_worker(self):
+        if self.__worker is not None and self.__worker.is_alive():
+            return
+        self.__stop = False
+        self.__worker = threading.Thread(target = self.__io_func, daemon = True)
+        self.__worker.start()
+
+    def __io_func(self):
+        poller = zmq.Poller()
+        poller.register(self.__sock, zmq.POLLIN)
+        poller.register(self.__ctrl_recv, zmq.POLLIN)
+        while True:
+            events = dict(poller.poll())
+            if self.__ctrl_recv in events:
+                self.__ctrl_recv.recv()
+                if self.__stop:
+                    break
+                while self.__outbox:
+                    self.__sock.send_multipart(self.__outbox.popleft())
+            if self.__sock in events:
+                for _ in range(self.max_batch):
+                    try:
+                        frames = self.__sock.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    self.__handle_msg(frames)
+
+    def __handle_msg(self, frames):
+        # [identity, (b'' for REQ clients), command, content...]
+        ident = frames[0].bytes
+        req = len(frames) > 1 and len(frames[1]) == 0
+        body = frames[2:] if req else frames[1:]
+        client = ident.hex()
+        session = self.__sessions.get(client)
+        if session is None:
+            session = self.__sessions[client] = self.Session(ident, req)
+            if not req:
+                session.credits = Credits(self.window)
+        if not body:
+            return
+        cmd = body[0].bytes.decode()
+        if cmd == "hello":
+            # new streaming client or one that ran out of credit. A reconnected client has a new
+            # identity and session anyway.
+            with self.__cond:
+                n = session.credits.hello(hello_token(body))
+            if n > 0:
+                self.__sock.send_multipart([ident, b"credit", n.to_bytes(4, byteorder = 'little')])
+            return
+        if cmd == "images":
+            session.nimgs += 1
+            data = self.__pool.submit(parse_imgs, body[1:], self.compress_stats)
+        elif cmd == "config":
+            data = session.config = [body[1].bytes.decode(), body[2].bytes.decode()]
+        elif cmd == "end_seq":
+            data = session.seq = int.from_bytes(body[1].bytes, byteorder = 'little')
+        else:
+            data = None
+        with self.__cond:
+            self.__msgs.append((session, cmd, data))
+            self.__cond.notify_all()
+
+    def __send(self, frames):
+        self.__outbox.append(frames)
+        self.__ctrl_send.send(b'')
+
+    def __find_msg(self, client):
+        for i, msg in enumerate(self.__msgs):
+            if client is None or msg[0].client == client:
+                return i
+        return None
+
+    def recv_msg(self, client=None, timeout=1):
+        # [client, command, content] of the next message, from client if it isn't None.
+        # Returns None if there is none within timeout seconds. The content is [shape, imgdata] for
+        # images (see AnalysisServer.recv_imgs), [dateStamp, timeStamp] for config and an int for end_seq.
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.__find_msg(client) is not None, timeout):
+                return
+            i = self.__find_msg(client)
+            session, cmd, data = self.__msgs[i]
+            del self.__msgs[i]
+            if not session.req:
+                n = session.credits.take()
+        if session.req:
+            self.__send([session.ident, b'', int(not session.stopped).to_bytes(1, byteorder = 'little')])
+        else:
+            self.__send([session.ident, b"credit", n.to_bytes(4, byteorder = 'little')])
+        if isinstance(data, Future):
+            data = data.result()
+        return [session.client, cmd, data]
+
+    def get_clients(self):
+        return list(self.__sessions)
+
+    def get_session(self, client):
+        # config, last end_seq and number of image messages of client
+        session = self.__sessions[client]
+        return {'config': session.config, 'seq': session.seq, 'nimgs': session.nimgs}
+
+    def send_go(self, client):
+        session = self.__sessions[client]
+        session.stopped = False
+        if not session.req:
+            self.__send([session.ident, b"go"])
+
+    def send_stop(self, client):
+        # a REQ client is told with the reply to its next message
+        session = self.__sessions[client]
+        session.stopped = True
+        if not session.req:
+            self.__send([session.ident, b"stop"])
+
+    def get_compress_stats(self):
+        return self.compress_stats.to_dict()
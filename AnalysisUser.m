@@ -3,6 +3,7 @@
 classdef AnalysisUser < handle
     properties
         AU;
+        split_blocks = false; % see AnalysisClient.split_blocks
     end
 
     methods(Access = private)
@@ -21,11 +22,12 @@ classdef AnalysisUser < handle
 
     methods
         function res = check_msg(self)
-            res = self.AU.check_msg();
-            if res ~= py.None
-                res = char(res{1});
-            else
+            res = cell(self.AU.check_msg());
+            if isa(res{1}, 'py.NoneType')
+                % the server didn't reply
                 res = '';
+            else
+                res = char(res{1});
             end
         end
         function pause_seq(self)
@@ -37,27 +39,141 @@ classdef AnalysisUser < handle
         function start_seq(self)
             self.AU.start_seq();
         end
+        function use_cursor(self, index)
+            % read images from the server's image log starting at index
+            % instead of taking them out of the server's queue, so other
+            % clients still see every sequence.
+            if ~exist('index', 'var')
+                index = 0;
+            end
+            self.AU.use_cursor(int64(index));
+        end
+        function subscribe(self, sub_url)
+            % receive images as soon as each sequence finishes from the
+            % ExptServer PUB socket (see ExptServer.set_publish)
+            self.AU.subscribe(sub_url);
+        end
+        function set_roi(self, rois, binning)
+            % have the server crop the images to rois ([x0 x1 y0 y1] rows,
+            % 1-based and inclusive) and bin them, see AnalysisClient.set_roi
+            if ~exist('binning', 'var')
+                binning = 1;
+            end
+            self.split_blocks = ~isempty(rois);
+            self.AU.set_roi(AnalysisClient.roi_list(rois), int64(binning));
+        end
         function set_refresh_rate(self, val)
             self.AU.set_refresh_rate(val);
         end
+        function set_chunk_size(self, max_seqs, max_bytes)
+            self.AU.set_chunk_size(int64(max_seqs), int64(max_bytes));
+        end
         function res = get_refresh_rate(self)
             res = double(self.AU.get_refresh_rate());
         end
         function info = grab_imgs(self)
-            res = cell(self.AU.grab_imgs());
-            info.imgs = {};
-            info.scan_ids = [];
-            info.seq_ids = [];
-            for i = 1:length(res)
-                this_info = AnalysisClient.process_imgs(double(res{i}));
-                if isempty(this_info.imgs)
-                    continue;
+            info = AnalysisClient.process_seqs(self.AU.grab_imgs(), false, self.split_blocks);
+        end
+        function info = grab_scan(self, scan_id)
+            % only the images of scan_id, the other scans stay cached
+            info = AnalysisClient.process_seqs(self.AU.grab_scan(int64(scan_id)), false, self.split_blocks);
+        end
+        function res = get_scan_ids(self)
+            res = cellfun(@double, cell(self.AU.get_scan_ids()));
+        end
+        function set_cache_limit(self, max_bytes)
+            % oldest images of the least recently used scans are dropped
+            % once more than max_bytes are cached
+            self.AU.set_cache_limit(int64(max_bytes));
+        end
+        function add_reducer(self, name, reducer)
+            % reducer is a python reducer from Reducers.py, e.g.
+            % py.Reducers.RoiSum(py.list({py.list({0, 5, 0, 5})}))
+            self.AU.add_reducer(name, reducer);
+        end
+        function remove_reducer(self, name)
+            self.AU.remove_reducer(name);
+        end
+        function set_keep_raw(self, keep_raw)
+            % whether the images of reduced sequences are kept for grab_imgs
+            self.AU.set_keep_raw(logical(keep_raw));
+        end
+        function info = grab_reduced(self)
+            % results of the reducers, info.results{i}.(name) for sequence i
+            res = cell(self.AU.grab_reduced());
+            nseqs = length(res);
+            info.scan_ids = zeros(1, nseqs);
+            info.seq_ids = zeros(1, nseqs);
+            info.results = cell(1, nseqs);
+            info.errors = cell(1, nseqs);
+            for i = 1:nseqs
+                seq = res{i};
+                info.scan_ids(i) = double(seq.scan_id);
+                info.seq_ids(i) = double(seq.seq_id);
+                results = struct();
+                names = cell(py.list(seq.results.keys()));
+                for j = 1:length(names)
+                    results.(char(names{j})) = AnalysisUser.to_double(seq.results.get(names{j}));
+                end
+                info.results{i} = results;
+                if seq.error ~= py.None
+                    info.errors{i} = char(seq.error);
+                else
+                    info.errors{i} = '';
+                end
+            end
+        end
+        function enable_stats(self, threshold, survival)
+            % keep running statistics for every scan point. threshold is a
+            % py.Reducers.Threshold used to detect atoms and survival a
+            % list of [loading image, survival image] pairs, 1-based.
+            if ~exist('threshold', 'var')
+                self.AU.enable_stats();
+                return
+            end
+            pairs = py.list();
+            for i = 1:size(survival, 1)
+                pairs.append(py.tuple({int64(survival(i, 1) - 1), int64(survival(i, 2) - 1)}));
+            end
+            self.AU.enable_stats(threshold, pairs);
+        end
+        function set_scan_params(self, scan_id, params)
+            % Scan.Params of the scan, maps every seq_id to its scan point
+            self.AU.set_scan_params(int64(scan_id), py.list(num2cell(int64(params))));
+        end
+        function res = get_point_stats(self, scan_id, param)
+            % n, mean, variance and, if atoms are detected, loading and
+            % survival of scan point param. Empty if there are no statistics.
+            % mean and variance are cell arrays with one entry per block.
+            stats = self.AU.get_point_stats(int64(scan_id), int64(param));
+            if stats == py.None
+                res = [];
+                return
+            end
+            res = struct();
+            names = cell(py.list(stats.keys()));
+            for i = 1:length(names)
+                val = stats.get(names{i});
+                if isa(val, 'py.list')
+                    res.(char(names{i})) = cellfun(@AnalysisUser.to_double, cell(val), 'UniformOutput', false);
+                else
+                    res.(char(names{i})) = AnalysisUser.to_double(val);
                 end
-                info.imgs = horzcat(info.imgs, this_info.imgs);
-                info.scan_ids = horzcat(info.scan_ids, this_info.scan_ids);
-                info.seq_ids = horzcat(info.seq_ids, this_info.seq_ids);
             end
         end
+        function res = get_stat_points(self, scan_id)
+            res = cellfun(@double, cell(self.AU.get_stat_points(int64(scan_id))));
+        end
+        function clear_stats(self, scan_id)
+            if exist('scan_id', 'var')
+                self.AU.clear_stats(int64(scan_id));
+            else
+                self.AU.clear_stats();
+            end
+        end
+        function res = get_num_evicted(self)
+            res = double(self.AU.get_num_evicted());
+        end
         function res = get_seq_num(self)
         end
         function res = get_config(self)
@@ -77,6 +193,19 @@ classdef AnalysisUser < handle
         cache = containers.Map();
     end
     methods(Static)
+        function res = to_double(val)
+            % python number or numpy array to a double array of the same shape
+            if val == py.None
+                res = [];
+                return
+            end
+            val = py.numpy.asarray(val);
+            shape = cellfun(@double, cell(val.shape));
+            res = double(py.array.array('d', py.numpy.ravel(val, 'F')));
+            if length(shape) >= 2
+                res = reshape(res, shape);
+            end
+        end
         function dropAll()
             remove(AnalysisUser.cache, keys(AnalysisUser.cache));
         end
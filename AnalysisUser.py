@@ -1,4 +1,6 @@
 from AnalysisClient import AnalysisClient
+from ImgStore import SeqCache
+from Reducers import ReducePipeline, ScanStats
 from enum import Enum
 import time
 import threading
@@ -11,6 +13,8 @@ class AnalysisUser(object):
         PauseSeq = 2
         AbortSeq = 3
         StartSeq = 4
+        Subscribe = 5
+        SetRoi = 6
 
     class SeqStatus(Enum):
         Stopped = 0
@@ -24,52 +28,77 @@ class AnalysisUser(object):
         #elf.__user_lock = threading.Lock()
         self.__worker_lock = threading.Lock()
 
+        self.__url = url
         self.AC = AnalysisClient(url)
+        # set whenever a request is sent to the worker
+        self.__req_event = threading.Event()
+        # how long each long poll for a status change waits on the server, in seconds
+        self.status_timeout = 5
 
-        # deque for imgs
-        #with self.__user_lock:
-        self.user_imgs = [] # deque that is swapped with deque populated by worker
         with self.__data_lock:
             self.seq_status = self.SeqStatus.Unknown
             self.seq_num = 0
             self.refresh_rate = 60 # in seconds
-            self.imgs = []
+            # limits of each chunk of images fetched from the server
+            self.chunk_seqs = 16
+            self.chunk_bytes = 64 * 1024 * 1024
+            # ImgFormat.SeqImgs received, by scan. Bounded so that long unattended scans don't use up the memory.
+            self.imgs = SeqCache(2 * 1024 * 1024 * 1024)
+            # reducers run on every sequence as it arrives, see Reducers.py
+            self.reducers = ReducePipeline()
+            self.reduced = [] # list of Reducers.ReducedSeq
+            self.keep_raw = True # also keep the images of reduced sequences in self.imgs
+            # running statistics per scan point, None when disabled
+            self.stats = None
             self.config = None
-            self.msg = ""
+            self.msg = [""] # reply to the last request or status change, always a one element list
+            self.sub_url = "" # url of the ExptServer PUB socket, if any
+            self.rois = None # [rois, binning] the server crops and bins the images to
+            # index of the next sequence to read from the server's image log,
+            # None to take the images out of the server's queue instead
+            self.cursor = None
+            self.nmissed = 0 # sequences that dropped out of the log before we read them
 
         self.last_time = 0
 
         # worker. Worker will tell AnalysisClient what to do, which is going to going to grab images automatically when sequence is running
-        with self.__worker_lock:
-            self.__worker_reqs = deque()
-        self.__worker = threading.Thread(target = self.__worker_func)
-        self.__worker.start()
+        # The status is tracked by a separate thread long polling the server for changes.
+        self.__worker = None
+        self.__status_worker = None
+        self.start_worker()
 
     def __del__(self):
         self.stop_worker()
 
     def stop_worker(self):
-        if hasattr(self, '__worker'):
-            with self.__worker_lock:
-                self.__worker_reqs.appendleft(self.WorkerRequest.Stop)
-            self.__worker.join()
-        else:
+        if self.__worker is None or not self.__worker.is_alive():
             return
+        # the status thread finishes after its current long poll, no need to wait for it
+        self.__status_stop.set()
+        self.__send_worker_req(self.WorkerRequest.Stop)
+        self.__worker.join()
 
     def start_worker(self):
-        if hasattr(self, '__worker'):
-            if self.__worker.is_active():
-                return
+        if self.__worker is not None and self.__worker.is_alive():
+            return
         with self.__worker_lock:
             self.__worker_reqs = deque()
         self.__worker = threading.Thread(target = self.__worker_func)
         self.__worker.start()
+        # every status thread gets its own stop event so that an old one still finishing its
+        # long poll isn't restarted
+        self.__status_stop = threading.Event()
+        self.__status_worker = threading.Thread(target = self.__status_func,
+                                                args = (self.__status_stop,), daemon = True)
+        self.__status_worker.start()
 
     def reset_client(self):
         with self.__AC_lock:
             self.AC.recreate_sock()
 
     def __pop_worker_req(self):
+        # clear the event first so that a request sent after we looked at the queue still wakes us up
+        self.__req_event.clear()
         with self.__worker_lock:
             try:
                 res = self.__worker_reqs.pop()
@@ -80,54 +109,135 @@ class AnalysisUser(object):
     def __send_worker_req(self, req):
         with self.__worker_lock:
             self.__worker_reqs.appendleft(req)
+        self.__req_event.set()
 
     def __handle_req(self, req):
-        msg = None
+        rep = None
         if req == self.WorkerRequest.NoRequest:
-            time.sleep(0.1)
+            if self.AC.is_subscribed():
+                # new sequences are pushed to us, wait for them instead of sleeping
+                self.__recv_published(100)
+            else:
+                # sleep until the next refresh or until a request comes in
+                with self.__data_lock:
+                    refresh_rate = self.refresh_rate
+                self.__req_event.wait(max(0, self.last_time + refresh_rate - time.time()))
+        elif req == self.WorkerRequest.Subscribe:
+            with self.__data_lock:
+                sub_url = self.sub_url
+            self.AC.subscribe(sub_url)
+        elif req == self.WorkerRequest.SetRoi:
+            with self.__data_lock:
+                rois, binning = self.rois
+            rep = self.AC.set_roi(rois=rois, binning=binning)
         elif req == self.WorkerRequest.PauseSeq:
-            msg = self.AC.pause_seq()
-            msg = msg[0]
+            rep = self.AC.pause_seq()
             self.__update()
         elif req == self.WorkerRequest.AbortSeq:
-            msg = self.AC.abort_seq()
-            msg = msg[0]
+            rep = self.AC.abort_seq()
             self.__update()
         elif req == self.WorkerRequest.StartSeq:
-            msg = self.AC.start_seq()
-            msg = msg[0]
+            rep = self.AC.start_seq()
             self.__update()
-        if msg is not None:
-            self.__set_msg(msg)
-
-    def __update_status(self):
-        # get status
-        status = self.AC.get_status()
-        if status[0] == "Sequence is stopped":
-            state = self.SeqStatus.Stopped
-        elif status[0] == "Sequence is paused":
-            state = self.SeqStatus.Paused
-        elif status[0] == "Sequence is running":
-            state = self.SeqStatus.Running
-        else:
-            state = self.SeqStatus.Unknown
-        self.__set_status(state)
-        self.__set_msg(status)
-        return state
+        if rep is not None:
+            # only the reply string, as a one element list like the status replies
+            self.__set_msg([rep[0]])
+
+    def __parse_status(self, status):
+        if status == "Sequence is stopped":
+            return self.SeqStatus.Stopped
+        elif status == "Sequence is paused":
+            return self.SeqStatus.Paused
+        elif status == "Sequence is running":
+            return self.SeqStatus.Running
+        return self.SeqStatus.Unknown
+
+    def __status_func(self, stop):
+        # waits on the server for the status to change, so that pause/abort/run transitions
+        # are seen right away without constantly polling the server
+        AC = AnalysisClient(self.__url)
+        status = ""
+        try:
+            while not stop.is_set():
+                rep = AC.wait_status_change(status, self.status_timeout)
+                if stop.is_set():
+                    break
+                if rep[0] is None:
+                    # no reply, the REQ socket can't be used until it is recreated
+                    AC.recreate_sock()
+                    self.__set_status(self.SeqStatus.Unknown)
+                    status = ""
+                    continue
+                status = rep[0]
+                self.__set_status(self.__parse_status(status))
+                self.__set_msg(rep)
+        finally:
+            AC.close()
+
+    def __recv_published(self, timeout):
+        new_imgs = self.AC.recv_published(timeout)
+        if new_imgs:
+            self.__add_imgs(new_imgs)
+
+    def __add_imgs(self, new_imgs):
+        with self.__data_lock:
+            if self.stats is not None:
+                for seq in new_imgs:
+                    self.stats.add(seq)
+            if self.reducers.active():
+                for seq in new_imgs:
+                    # wake the worker up to collect the result
+                    self.reducers.submit(seq, self.__req_event.set)
+                if not self.keep_raw:
+                    return
+            self.imgs.extend(new_imgs)
+
+    def __collect_reduced(self):
+        with self.__data_lock:
+            if self.reducers.npending():
+                self.reduced.extend(self.reducers.collect())
 
     def __update(self):
         # this function runs every refresh rate, and can also be called on its own
-        # get imgs
-        new_imgs = self.AC.get_imgs(10000)
-        if new_imgs is not None:
+        if self.AC.is_subscribed():
+            # images are pushed to us as soon as each sequence finishes
+            self.__recv_published(0)
+        else:
+            # get imgs, the backlog is fetched in bounded chunks so that no single reply gets too large
             with self.__data_lock:
-                self.imgs.append(new_imgs)
+                max_seqs = self.chunk_seqs
+                max_bytes = self.chunk_bytes
+                cursor = self.cursor
+            if cursor is None:
+                for new_imgs in self.AC.iter_imgs(10000, max_seqs, max_bytes):
+                    self.__add_imgs(new_imgs)
+            else:
+                self.__read_log(cursor, max_seqs, max_bytes)
         # get nseq
         nseq = self.AC.get_seq_num()
         if nseq is not None:
             with self.__data_lock:
                 self.seq_num = nseq
 
+    def __read_log(self, cursor, max_seqs, max_bytes):
+        more = True
+        while more:
+            rep = self.AC.get_imgs_since(10000, index=cursor, max_seqs=max_seqs, max_bytes=max_bytes)
+            if rep is None:
+                return
+            next_cursor, first, more, new_imgs, reset = rep
+            with self.__data_lock:
+                if self.cursor is None:
+                    # switched back to the queue in the meantime
+                    return
+                if not reset:
+                    self.nmissed = self.nmissed + max(0, first - cursor)
+                # otherwise our cursor was past the end of the log, e.g. the server restarted,
+                # and new_imgs start over from first
+                self.cursor = next_cursor
+            self.__add_imgs(new_imgs)
+            cursor = next_cursor
+
     def check_status(self):
         with self.__data_lock:
             return self.seq_status
@@ -152,34 +262,117 @@ class AnalysisUser(object):
         while req != self.WorkerRequest.Stop:
             cur_time = time.time()
             if cur_time - self.last_time >= self.refresh_rate:
-                # __update status. Cached status, in principle is good enough, but this is mainly to protect against stopping of the sequence that this thread does not know about
-                # state = self.__update_status()
                 self.__update()
                 self.last_time = cur_time
             self.__handle_req(req)
-            self.__update_status()
+            self.__collect_reduced()
             req = self.__pop_worker_req()
+        with self.__data_lock:
+            self.reducers.shutdown()
 
     def pop_img(self):
-        try:
-            res = self.user_imgs.pop()
-        except:
-            res = None
-        return res
+        with self.__data_lock:
+            return self.imgs.pop_oldest()
 
     #functions for main thread to extract data
     def grab_imgs(self):
-        # get cached
-        # assumes self.user_imgs is cleared already
+        # get cached, the sequences are handed over without copying
+        with self.__data_lock:
+            return self.imgs.pop_all()
+
+    def grab_scan(self, scan_id):
+        # only the sequences of scan_id, the other scans stay cached
+        with self.__data_lock:
+            return self.imgs.pop_scan(int(scan_id))
+
+    def get_seq(self, scan_id, seq_id):
+        # look up a cached sequence without removing it, None if it isn't cached
+        with self.__data_lock:
+            return self.imgs.get_seq(int(scan_id), int(seq_id))
+
+    def get_scan_ids(self):
+        with self.__data_lock:
+            return self.imgs.scan_ids()
+
+    def set_cache_limit(self, max_bytes):
+        # older sequences of the least recently used scans are dropped once more than max_bytes are cached
         with self.__data_lock:
-            self.user_imgs, self.imgs = self.imgs, self.user_imgs
-        res = self.user_imgs.copy()
-        self.user_imgs.clear()
+            self.imgs.set_limit(None if max_bytes is None else int(max_bytes))
+
+    def add_reducer(self, name, reducer):
+        # run reducer (see Reducers.py) on every new sequence in a process pool,
+        # the results are grabbed with grab_reduced
+        with self.__data_lock:
+            self.reducers.add(str(name), reducer)
+
+    def remove_reducer(self, name):
+        with self.__data_lock:
+            self.reducers.remove(str(name))
+
+    def set_reduce_workers(self, nworkers):
+        # number of processes running the reducers, None for one per core
+        with self.__data_lock:
+            self.reducers.set_workers(None if nworkers is None else int(nworkers))
+
+    def set_keep_raw(self, keep_raw):
+        # whether the images of sequences that are reduced are kept as well
+        with self.__data_lock:
+            self.keep_raw = bool(keep_raw)
+
+    def grab_reduced(self):
+        with self.__data_lock:
+            res, self.reduced = self.reduced, []
         return res
 
+    def enable_stats(self, threshold=None, survival=()):
+        # keep running mean/variance images, loading and survival probabilities for every scan point.
+        # threshold is a Reducers.Threshold used to detect the atoms, survival a list of
+        # (loading image, survival image) pairs, see Reducers.ScanStats
+        with self.__data_lock:
+            self.stats = ScanStats(threshold, survival)
+
+    def disable_stats(self):
+        with self.__data_lock:
+            self.stats = None
+
+    def set_scan_params(self, scan_id, params):
+        # parameter index of every sequence of the scan (Scan.Params after stacking and scrambling)
+        with self.__data_lock:
+            if self.stats is not None:
+                self.stats.set_params(int(scan_id), params)
+
+    def get_point_stats(self, scan_id, param):
+        # dict with the current statistics of one scan point, None if there are none
+        with self.__data_lock:
+            if self.stats is None:
+                return None
+            return self.stats.get(int(scan_id), int(param))
+
+    def get_stat_points(self, scan_id):
+        with self.__data_lock:
+            if self.stats is None:
+                return []
+            return self.stats.point_indices(int(scan_id))
+
+    def clear_stats(self, scan_id=None):
+        with self.__data_lock:
+            if self.stats is not None:
+                self.stats.clear(None if scan_id is None else int(scan_id))
+
+    def get_num_evicted(self):
+        with self.__data_lock:
+            return self.imgs.nevicted
+
     def set_refresh_rate(self, val):
         with self.__data_lock:
             self.refresh_rate = val
+        # the worker may be sleeping until the next refresh at the old rate
+        self.__req_event.set()
+
+    def set_chunk_size(self, max_seqs, max_bytes):
+        with self.__data_lock:
+            self.chunk_seqs = int(max_seqs)
+            self.chunk_bytes = int(max_bytes)
 
     def get_refresh_rate(self):
         with self.__data_lock:
@@ -196,6 +389,29 @@ class AnalysisUser(object):
         with self.__data_lock:
             return self.seq_status.value
 
+    def use_cursor(self, index=0):
+        # read images from the server's image log (see ExptServer.set_log_retention) starting at index
+        # without taking them away from other clients. None switches back to taking them from the queue.
+        with self.__data_lock:
+            self.cursor = None if index is None else int(index)
+
+    def get_num_missed(self):
+        with self.__data_lock:
+            return self.nmissed
+
+    def subscribe(self, sub_url):
+        # switch to receiving images pushed from the ExptServer PUB socket at sub_url
+        # instead of polling for them every refresh rate. An empty sub_url switches back to polling.
+        with self.__data_lock:
+            self.sub_url = sub_url
+        self.__send_worker_req(self.WorkerRequest.Subscribe)
+
+    def set_roi(self, rois=None, binning=1):
+        # have the server crop and bin the images before sending them, see AnalysisClient.set_roi
+        with self.__data_lock:
+            self.rois = [rois, binning]
+        self.__send_worker_req(self.WorkerRequest.SetRoi)
+
     def pause_seq(self):
         self.__send_worker_req(self.WorkerRequest.PauseSeq)
 
@@ -0,0 +1,127 @@
+import zmq
+import zmq.asyncio
+import asyncio
+import itertools
+import json
+import ImgFormat
+
+class AsyncAnalysisClient(ImgFormat.ImgRequestOpts):
+    # asyncio version of AnalysisClient. Requests go over a DEALER socket with a request id in the
+    # routing envelope, so any number of requests can be in flight at once and each reply is
+    # matched to its request. A timed out request doesn't leave the socket in a broken state,
+    # its reply is simply dropped when it arrives.
+    def recreate_sock(self):
+        if self.__sock is not None:
+            self.__sock.close()
+        if self.__reader is not None:
+            self.__reader.cancel()
+            self.__reader = None
+        for fut in self.__pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError("Socket recreated"))
+        self.__pending = {}
+        self.__sock = self.__ctx.socket(zmq.DEALER)
+        self.__sock.setsockopt(zmq.LINGER, 0)
+        self.__sock.connect(self.__url)
+
+    def __init__(self, url: str):
+        # network
+        self.__url = url
+        self.__ctx = zmq.asyncio.Context()
+        self.__sock = None
+        self.__reader = None
+        self.__pending = {} # request id -> future of the reply frames
+        self.__ids = itertools.count()
+        self.recreate_sock()
+        self.timeout = 1 # in seconds
+        self.img_timeout = 10 # in seconds, for get_imgs/get_imgs_since which fetch up to max_bytes
+        self.init_img_opts()
+
+    def close(self):
+        if self.__reader is not None:
+            self.__reader.cancel()
+        self.__sock.close()
+        self.__ctx.destroy()
+
+    async def __read_replies(self):
+        while True:
+            frames = await self.__sock.recv_multipart(copy=False)
+            # [request id, b'', reply frames...]
+            fut = self.__pending.pop(frames[0].bytes, None)
+            if fut is not None and not fut.done():
+                fut.set_result(frames[2:])
+
+    async def request(self, cmd: str, opts=None, timeout=None):
+        # send a request and wait for the reply frames. Raises asyncio.TimeoutError on timeout.
+        if self.__reader is None or self.__reader.done():
+            self.__reader = asyncio.ensure_future(self.__read_replies())
+        req_id = next(self.__ids).to_bytes(8, 'little')
+        fut = asyncio.get_running_loop().create_future()
+        self.__pending[req_id] = fut
+        frames = [req_id, b'', cmd.encode()]
+        if opts is not None:
+            frames.append(json.dumps(opts).encode())
+        try:
+            await self.__sock.send_multipart(frames)
+            return await asyncio.wait_for(fut, self.timeout if timeout is None else timeout)
+        finally:
+            self.__pending.pop(req_id, None)
+
+    async def request_string(self, cmd: str, opts=None, timeout=None) -> str:
+        rep = await self.request(cmd, opts, timeout)
+        return rep[0].bytes.decode()
+
+    async def request_int(self, cmd: str, opts=None, timeout=None) -> int:
+        rep = await self.request(cmd, opts, timeout)
+        return int.from_bytes(rep[0].bytes, 'little')
+
+    async def pause_seq(self, timeout=None) -> str:
+        return await self.request_string("pause_seq", timeout=timeout)
+
+    async def abort_seq(self, timeout=None) -> str:
+        return await self.request_string("abort_seq", timeout=timeout)
+
+    async def start_seq(self, timeout=None) -> str:
+        return await self.request_string("start_seq", timeout=timeout)
+
+    async def get_status(self, timeout=None) -> str:
+        return await self.request_string("get_status", timeout=timeout)
+
+    async def get_seq_num(self, timeout=None) -> int:
+        return await self.request_int("get_seq_num", timeout=timeout)
+
+    async def get_num_imgs(self, timeout=None) -> int:
+        return await self.request_int("get_num_imgs", timeout=timeout)
+
+    async def get_config(self, timeout=None):
+        rep = await self.request("get_config", timeout=timeout)
+        return [frame.bytes.decode() for frame in rep]
+
+    async def set_roi(self, rois=None, binning=1, timeout=None) -> str:
+        # crop and bin all the images fetched by this client on the server, see AnalysisClient.set_roi
+        return await self.request_string("set_roi", self.set_view_opts(rois, binning), timeout)
+
+    async def get_stats(self, timeout=None):
+        return json.loads(await self.request_string("get_stats", timeout=timeout))
+
+    async def get_imgs(self, max_seqs=16, max_bytes=64 * 1024 * 1024, timeout=None):
+        # one bounded chunk of the queued images, returns [more, seqs]
+        if timeout is None:
+            timeout = self.img_timeout
+        rep = await self.request("get_imgs_multipart",
+                                 self.img_opts(max_seqs=max_seqs, max_bytes=max_bytes), timeout)
+        flags, seqs = ImgFormat.decode_stream(rep, self.compress_stats)
+        return [bool(flags & ImgFormat.FLAG_MORE), seqs]
+
+    async def get_imgs_since(self, index=0, max_seqs=16, max_bytes=64 * 1024 * 1024, timeout=None):
+        # non-destructive read of the image log, returns [next index, first retained index, more, seqs, reset]
+        # (see AnalysisClient.get_imgs_since)
+        if timeout is None:
+            timeout = self.img_timeout
+        rep = await self.request("get_imgs_since",
+                                 self.img_opts(index=index, max_seqs=max_seqs, max_bytes=max_bytes),
+                                 timeout)
+        info = json.loads(rep[0].bytes)
+        flags, seqs = ImgFormat.decode_stream(rep[1:], self.compress_stats)
+        return [info['next'], info['first'], bool(flags & ImgFormat.FLAG_MORE), seqs,
+                info.get('reset', False)]
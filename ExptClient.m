@@ -3,33 +3,43 @@
 classdef ExptClient < handle
     properties
         client;
+        stream; % pipelined streaming transport with credit based flow control
     end
 
     methods(Access = private)
-        function self = ExptClient(url)
+        function self = ExptClient(url, stream)
             [path, ~, ~] = fileparts(mfilename('fullpath'));
             pyglob = py.dict(pyargs('mat_srcpath', path, 'url', url));
             try
-                py.exec('from ExptClient import ExptClient', pyglob);
+                py.exec('from ExptClient import ExptClient, ExptStreamClient', pyglob);
             catch
                 py.exec('import sys; sys.path.append(mat_srcpath)', pyglob);
-                py.exec('from ExptClient import ExptClient', pyglob);
+                py.exec('from ExptClient import ExptClient, ExptStreamClient', pyglob);
+            end
+            self.stream = stream;
+            if stream
+                self.client = py.eval('ExptStreamClient(url)', pyglob);
+            else
+                self.client = py.eval('ExptClient(url)', pyglob);
             end
-            self.client = py.eval('ExptClient(url)', pyglob);
         end
     end
 
     methods
         function res = send_imgs(self, img)
             shape = size(img);
-            res = self.client.send_imgs(img(:)', shape);
+            res = self.send(@() self.client.send_imgs(img(:)', shape));
         end
         function res = send_config(self, dateStamp, timeStamp)
             % date and timeStamp should be strings. 
-            res = self.client.send_config(dateStamp, timeStamp);
+            res = self.send(@() self.client.send_config(dateStamp, timeStamp));
         end
         function res = send_end_seq(self, data)
-            res = self.client.send_end_seq(int64(data));
+            res = self.send(@() self.client.send_end_seq(int64(data)));
+        end
+        function res = check_stop(self)
+            % streaming only, whether the analysis asked us to stop
+            res = logical(self.client.check_stop());
         end
         function result = recv_reply(self)
             cleanup = register_cleanup(self);
@@ -56,6 +66,25 @@ classdef ExptClient < handle
 %             end
 %             cleanup.disable();
 %         end
+        function set_compression(self, method, level)
+            % method is 'zlib', 'lzma' or '' for no compression
+            if ~exist('level', 'var')
+                level = 1;
+            end
+            self.client.set_compression(method, int64(level));
+        end
+        function res = send(self, fn)
+            if ~self.stream
+                res = fn();
+                return
+            end
+            % the streaming client doesn't send until it gets credit from the server
+            cleanup = register_cleanup(self);
+            while ~fn()
+            end
+            cleanup.disable();
+            res = true;
+        end
         function recreate_sock(self)
             self.client.recreate_sock();
         end
@@ -71,15 +100,20 @@ classdef ExptClient < handle
         function dropAll()
             remove(ExptClient.cache, keys(ExptClient.cache));
         end
-        function res = get(url)
+        function res = get(url, stream)
+            % stream selects the streaming transport (ExptStreamClient),
+            % both ends of a connection have to use the same one.
+            if ~exist('stream', 'var')
+                stream = false;
+            end
             cache = ExptClient.cache;
             if isKey(cache, url)
                 res = cache(url);
-                if ~isempty(res) && isvalid(res)
+                if ~isempty(res) && isvalid(res) && res.stream == stream
                     return;
                 end
             end
-            res = ExptClient(url);
+            res = ExptClient(url, stream);
             cache(url) = res;
         end
     end
@@ -1,7 +1,25 @@
 import zmq
+import os
 import array
+import json
+import ImgFormat
 
-class ExptClient(object):
+def img_frames(imgdata, shape, compress=None, level=1, stats=None):
+    # frames of an "images" message
+    frames = [b"images", shape.tobytes()]
+    if compress is None:
+        frames.append(ImgFormat.as_bytes(imgdata))
+        return frames
+    # compressed data is followed by a json frame describing how to decompress it
+    dtype = ImgFormat.dtype_code(memoryview(imgdata).format)
+    typecode = ImgFormat.dtypes[dtype][0]
+    itemsize = array.array(typecode).itemsize
+    code, data = ImgFormat.compress(imgdata, compress, level, 1 if typecode in 'df' else itemsize, stats)
+    frames.append(data)
+    frames.append(json.dumps({'compress': code, 'dtype': dtype}).encode())
+    return frames
+
+class ExptClient(ImgFormat.CompressOpts):
     def recreate_sock(self):
         if self.__sock is not None:
             self.__sock.close()
@@ -13,15 +31,13 @@ class ExptClient(object):
         self.__ctx = zmq.Context()
         self.__sock = None
         self.recreate_sock()
+        self.init_compression()
     def __del__(self):
         self.__sock.close()
         self.__ctx.destroy()
     def send_imgs(self, imgdata, shape):
-        shape_to_send = shape.tobytes()
-        data_to_send = imgdata.tobytes()
-        self.__sock.send_string("images", zmq.SNDMORE)
-        self.__sock.send(shape_to_send, zmq.SNDMORE)
-        return self.__sock.send(data_to_send)
+        return self.__sock.send_multipart(img_frames(imgdata, shape, self.compress, self.compress_level,
+                                                     self.compress_stats))
     def recv_reply(self):
         timeout = 1 * 1000 # in milliseconds
         if self.__sock.poll(timeout) == 0:
@@ -44,3 +60,70 @@ class ExptClient(object):
             return False
         self.__sock.recv()
         return True
+
+class ExptStreamClient(ImgFormat.CompressOpts):
+    # Streaming version of ExptClient for AnalysisServer.AnalysisStreamServer.
+    # Messages go out on one ordered DEALER stream without waiting for a reply to each of them,
+    # as long as the server has given us credit for them. The server hands back a credit for every
+    # message it has taken and sends go/stop in-band, check_stop returns the latest one.
+    def recreate_sock(self):
+        if self.__sock is not None:
+            self.__sock.close()
+        self.__sock = self.__ctx.socket(zmq.DEALER)
+        self.__sock.setsockopt(zmq.LINGER, 0)
+        self.__sock.connect(self.__url)
+        # the credit we had, including any the server sent that we never read, is gone with the old
+        # socket. A new session token tells the server to start counting over.
+        self.__token = os.urandom(8)
+        # the server replies with the initial window
+        self.credit = 0
+        self.__hello()
+    def __hello(self):
+        self.__sock.send_multipart([b"hello", self.__token])
+    def __init__(self, url):
+        self.__url = url
+        self.__ctx = zmq.Context()
+        self.__sock = None
+        self.credit = 0 # number of messages we can send before hearing from the server
+        self.stopped = False
+        self.timeout = 1 # in seconds
+        self.recreate_sock()
+        self.init_compression()
+    def __del__(self):
+        self.__sock.close()
+        self.__ctx.destroy()
+    def __handle_ctrl(self, timeout):
+        # process the messages from the server, waiting up to timeout ms for the first one
+        while self.__sock.poll(timeout):
+            msg = self.__sock.recv_multipart()
+            if msg[0] == b"credit":
+                self.credit += int.from_bytes(msg[1], byteorder = 'little')
+            elif msg[0] == b"stop":
+                self.stopped = True
+            elif msg[0] == b"go":
+                self.stopped = False
+            timeout = 0
+    def __send(self, frames):
+        # returns False if the server didn't give us credit in time, the message isn't sent then
+        self.__handle_ctrl(0)
+        if self.credit <= 0:
+            self.__handle_ctrl(self.timeout * 1000)
+            if self.credit <= 0:
+                # the credit may have been lost, e.g. the server recreated its socket with our
+                # messages in flight. Say hello again, the server tops us up to its window.
+                self.credit = 0
+                self.__hello()
+                return False
+        self.__sock.send_multipart(frames)
+        self.credit -= 1
+        return True
+    def send_imgs(self, imgdata, shape):
+        return self.__send(img_frames(imgdata, shape, self.compress, self.compress_level,
+                                      self.compress_stats))
+    def send_end_seq(self, data):
+        return self.__send([b"end_seq", data.to_bytes(4, byteorder='little')])
+    def send_config(self, dateStamp, timeStamp):
+        return self.__send([b"config", dateStamp.encode(), timeStamp.encode()])
+    def check_stop(self):
+        self.__handle_ctrl(0)
+        return self.stopped
@@ -31,13 +31,68 @@ classdef ExptServer < handle
         end
         function store_imgs(self, imgs, scan_id, seq_id)
 %             disp('storing imgs');
+            % pixels are sent in their native type (e.g. uint16 from the
+            % camera) together with the shape instead of widening to double.
+            % reshape shares the data with imgs, so the only copy is made by
+            % the conversion to python and the server keeps a reference to it.
+            if islogical(imgs)
+                imgs = uint8(imgs);
+            elseif ~isnumeric(imgs)
+                % e.g. char, which has no python image dtype
+                imgs = double(imgs);
+            end
             shape = size(imgs);
             if length(shape) == 2
-                to_send = [double(shape(1)) double(shape(2)) double(1) imgs(:)'];
-            elseif length(shape) == 3
-                to_send = [double(shape(1)) double(shape(2)) double(shape(3)) imgs(:)'];
+                shape = [shape 1];
+            end
+            res = self.server.store_imgs_buffer(reshape(imgs, 1, []), int64(shape), ...
+                                                class(imgs), scan_id, seq_id);
+        end
+        function set_queue_limits(self, max_seqs, max_bytes, policy, timeout)
+            % max_seqs/max_bytes of 0 means unlimited.
+            % policy:
+            % 0 - DropOldest
+            % 1 - DropNewest
+            % 2 - Block (for up to timeout seconds, then drop the new sequence)
+            if ~exist('policy', 'var')
+                policy = 0;
+            end
+            if ~exist('timeout', 'var')
+                timeout = 1;
+            end
+            self.server.set_queue_limits(int64(max_seqs), int64(max_bytes), ...
+                                         int64(policy), double(timeout));
+        end
+        function set_publish(self, pub_url, keep_queue)
+            % publish every finished sequence on a PUB socket at pub_url.
+            % The sequences are only also queued for get_imgs if keep_queue
+            % is true, then someone has to fetch them or set_queue_limits
+            % has to bound the queue.
+            if ~exist('keep_queue', 'var')
+                keep_queue = false;
+            end
+            self.server.set_publish(pub_url, keep_queue);
+        end
+        function set_log_retention(self, max_seqs, max_bytes, max_age, keep_queue)
+            % keep the last max_seqs sequences/max_bytes bytes/max_age
+            % seconds of finished sequences for clients reading with their
+            % own cursor (0 means no limit, all 0 turns the log off).
+            % if keep_queue is false, the sequences are not also queued for
+            % get_imgs.
+            if ~exist('max_age', 'var')
+                max_age = 0;
             end
-            res = self.server.store_imgs(to_send, scan_id, seq_id);
+            if ~exist('keep_queue', 'var')
+                keep_queue = true;
+            end
+            self.server.set_log_retention(int64(max_seqs), int64(max_bytes), ...
+                                          double(max_age), keep_queue);
+        end
+        function set_spill(self, path)
+            % keep finished sequences in an on disk store in the folder
+            % path so that the ones not fetched yet survive a crash or
+            % reset. An empty path turns this off.
+            self.server.set_spill(path);
         end
         function seq_cancel(self)
             self.server.seq_cancel();
@@ -2,8 +2,45 @@ import zmq
 from enum import Enum
 import threading
 from collections import deque
-import array
 import time
+import json
+import ImgFormat
+import ImgStore
+
+class TimedLock(object):
+    # threading.Lock that keeps track of how long threads waited to acquire it
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.wait_time = 0.0 # in seconds
+        self.max_wait = 0.0 # in seconds
+        self.nacquire = 0
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.perf_counter()
+        res = self.__lock.acquire(blocking, timeout)
+        if res:
+            # the counters are protected by the lock itself
+            dt = time.perf_counter() - t0
+            self.wait_time += dt
+            self.max_wait = max(self.max_wait, dt)
+            self.nacquire += 1
+        return res
+
+    def release(self):
+        self.__lock.release()
+
+    def locked(self):
+        return self.__lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def get_stats(self):
+        return {'wait_time': self.wait_time, 'max_wait': self.max_wait, 'nacquire': self.nacquire}
 
 class ExptServer(object):
     class State(Enum):
@@ -17,35 +54,64 @@ class ExptServer(object):
         NoRequest = 0
         Pause = 1
         Abort = 2
+    class OverflowPolicy(Enum):
+        DropOldest = 0
+        DropNewest = 1
+        Block = 2
 
     def recreate_sock(self):
+        # the worker polls the socket so it can't be running while the socket is replaced
+        running = self.worker_running()
+        if running:
+            self.stop_worker()
         if self.__sock is not None:
             self.__sock.close()
         self.__sock = self.__ctx.socket(zmq.ROUTER)
         self.__sock.bind(self.__url)
+        if running:
+            self.start_worker()
 
     def __init__(self, url: str):
         # network
         self.__url = url
         self.__ctx = zmq.Context()
         self.__sock = None
+        self.__worker = None
         self.recreate_sock()
-        self.timeout = 500
+        # maximum number of requests handled per wake up of the worker
+        self.max_batch = 64
+        # only touched by the worker
+        self.compress_stats = ImgFormat.CompressStats()
+        self.bytes_sent = 0
+        self.request_counts = {}
+        self.latencies = deque(maxlen=1000) # handle_msg latency of the last requests in seconds
+        # clients waiting for the status to change: [addr, last status, deadline]
+        self.status_waiters = []
+        # ImgFormat.ImgView registered by each client (by routing id) with set_roi, oldest first.
+        # Clients that reconnect get a new routing id, so only the last max_client_views are kept.
+        self.client_views = {}
+        self.max_client_views = 64
+        # inproc socket pair used to wake up the worker, e.g. to stop it.
+        # __ctrl_send is only used by the thread controlling the worker, __ctrl_recv only by the worker.
+        ctrl_url = f'inproc://ExptServer-ctrl-{id(self):x}'
+        self.__ctrl_recv = self.__ctx.socket(zmq.PAIR)
+        self.__ctrl_recv.bind(ctrl_url)
+        self.__ctrl_send = self.__ctx.socket(zmq.PAIR)
+        self.__ctrl_send.connect(ctrl_url)
+        # optional PUB socket finished sequences are pushed to. Only used by the expt thread.
+        self.__pub_sock = None
+        self.keep_queue = True
 
         # lock whenever accessing or changing state variables
-        self.__data_lock = threading.Lock()
+        self.__data_lock = TimedLock()
         # lock for worker request
         self.__worker_lock = threading.Lock()
         # lock for seq request
         self.__seq_lock = threading.Lock()
         # lock for expt imgs
-        self.__expt_lock = threading.Lock()
-
-        # worker. This worker will handle network requests
-        with self.__worker_lock:
-            self.__worker_req = self.WorkerRequest.NoRequest
-        self.__worker = threading.Thread(target = self.__worker_func)
-        self.__worker.start()
+        self.__expt_lock = TimedLock()
+        # signaled whenever images are taken out of the queue
+        self.__space_cond = threading.Condition(self.__data_lock)
 
         # data variables
         with self.__expt_lock:
@@ -56,7 +122,27 @@ class ExptServer(object):
             self.dateStamp = ""
             self.timeStamp = ""
             self.nseq_imgs = 0 # number of sequences of images stored
-        self.temp_imgs = [] # stored mid sequence
+            self.nbytes_imgs = 0 # number of bytes of images stored
+            self.ndropped = 0 # number of sequences dropped because the queue was full
+        self.temp_imgs = None # SeqImgs stored mid sequence
+        # optional on disk store finished sequences are spilled to
+        self.__spill = None
+        # log of finished sequences that any number of clients read with their own cursor.
+        # img_log[i] is (finish time, SeqImgs) of the sequence with index log_start + i.
+        # Sequences are only removed by the retention limits (0 means unlimited, all 0 disables the log).
+        with self.__data_lock:
+            self.img_log = deque()
+            self.log_start = 0
+            self.log_bytes = 0
+            self.log_max_seqs = 0
+            self.log_max_bytes = 0
+            self.log_max_age = 0 # in seconds
+        # limits of the image queue, 0 means unlimited
+        with self.__data_lock:
+            self.max_seqs = 0
+            self.max_bytes = 0
+            self.overflow_policy = self.OverflowPolicy.DropOldest
+            self.block_timeout = 1.0 # in seconds
 
         # status of seq
         with self.__seq_lock:
@@ -64,14 +150,47 @@ class ExptServer(object):
         with self.__data_lock:
             self.seq_status = self.State.Init
 
+        # worker. This worker will handle network requests
+        self.start_worker()
+
     def __del__(self):
         self.stop_worker()
         self.__sock.close()
+        self.__ctrl_send.close()
+        self.__ctrl_recv.close()
+        if self.__pub_sock is not None:
+            self.__pub_sock.close()
         self.__ctx.destroy()
 
+    def set_publish(self, pub_url, keep_queue=False):
+        # publish every finished sequence on a PUB socket bound to pub_url.
+        # Sequences are not queued for get_imgs as long as they are published or logged unless
+        # keep_queue is True, in which case someone has to fetch them or set_queue_limits bounds the queue.
+        # An empty pub_url turns publishing off.
+        if self.__pub_sock is not None:
+            self.__pub_sock.close()
+            self.__pub_sock = None
+        if pub_url:
+            self.__pub_sock = self.__ctx.socket(zmq.PUB)
+            self.__pub_sock.setsockopt(zmq.LINGER, 0)
+            self.__pub_sock.bind(pub_url)
+        self.keep_queue = bool(keep_queue)
+
+    def publish_seq(self, seq):
+        # topic frame followed by the sequence in the typed format
+        frames = [b'seq'] + ImgFormat.encode_frames([seq])
+        try:
+            self.__pub_sock.send_multipart(frames, zmq.NOBLOCK, copy=False)
+        except zmq.Again:
+            # nobody is keeping up, drop it for the subscribers
+            pass
+
     def reset(self):
         self.stop_worker()
         self.recreate_sock()
+        # the waiting clients were connected to the old socket
+        self.status_waiters = []
+        self.client_views = {}
         with self.__expt_lock:
             self.expt_imgs = deque() # this deque is the one the expt thread uses.
         with self.__data_lock:
@@ -80,31 +199,72 @@ class ExptServer(object):
             self.dateStamp = ""
             self.timeStamp = ""
             self.nseq_imgs = 0 # number of sequences of images stored
+            self.nbytes_imgs = 0 # number of bytes of images stored
+            self.ndropped = 0 # number of sequences dropped because the queue was full
+            # indices keep increasing so that clients' cursors stay valid
+            self.log_start = self.log_start + len(self.img_log)
+            self.img_log = deque()
+            self.log_bytes = 0
         with self.__seq_lock:
             self.__seq_req = self.SeqRequest.NoRequest
         with self.__data_lock:
             self.seq_status = self.State.Init
+            # sequences spilled to disk survive the reset
+            self.__load_spilled()
         self.start_worker()
 
+    def set_spill(self, path):
+        # store finished sequences in an on disk SpillStore at path instead of in memory.
+        # Sequences left in the store by a previous session are queued again.
+        # An empty path turns spilling off for new sequences.
+        with self.__data_lock:
+            if not path:
+                self.__spill = None
+                return
+            self.__spill = ImgStore.SpillStore(path)
+            self.__load_spilled()
+
+    def __load_spilled(self):
+        # call with __data_lock held. (Re)queue all the sequences in the store that were not fetched,
+        # they are older than everything else in the queue.
+        if self.__spill is None:
+            return
+        with self.__expt_lock:
+            # the store hands out new objects, drop the old copies of the spilled sequences
+            self.imgs = deque(seq for seq in self.imgs if not seq.spilled)
+            self.expt_imgs = deque(seq for seq in self.expt_imgs if not seq.spilled)
+        pending = self.__spill.load_pending()
+        for seq in reversed(pending):
+            self.imgs.append(seq)
+        self.nseq_imgs = len(self.imgs) + len(self.expt_imgs)
+        self.nbytes_imgs = (sum(seq.nbytes for seq in self.imgs) +
+                            sum(seq.nbytes for seq in self.expt_imgs))
+
+    def worker_running(self) -> bool:
+        return self.__worker is not None and self.__worker.is_alive()
+
     def stop_worker(self):
-        if hasattr(self, '__worker'):
-            with self.__worker_lock:
-                self.__worker_req = self.WorkerRequest.Stop
-            self.__worker.join()
-        else:
+        if not self.worker_running():
             return
+        with self.__worker_lock:
+            self.__worker_req = self.WorkerRequest.Stop
+        # wake up the worker right away instead of waiting for a poll timeout
+        self.__ctrl_send.send(b'')
+        self.__worker.join()
 
     def start_worker(self):
-        if hasattr(self, '__worker'):
-            if self.__worker.is_active():
-                return
+        if self.worker_running():
+            return
         with self.__worker_lock:
             self.__worker_req = self.WorkerRequest.NoRequest
         self.__worker = threading.Thread(target = self.__worker_func)
         self.__worker.start()
 
-    def handle_msg(self, addr,  msg_str: str) -> bool:
+    def handle_msg(self, addr,  msg_str: str, opts=None) -> bool:
         # Method to handle different requests from external clients
+        # opts is an optional dict of arguments sent as a json frame after the request string
+        if opts is None:
+            opts = {}
         if msg_str == "pause_seq":
             rep = self.pause_seq()
             self.safe_send_string(addr, rep)
@@ -116,25 +276,72 @@ class ExptServer(object):
             self.safe_send_string(addr, rep)
         elif msg_str == "get_status":
             rep = self.get_status()
-            self.safe_send_string(addr, rep)
+            if opts.get('dropped', False):
+                self.safe_send_string(addr, rep, zmq.SNDMORE)
+                self.__sock.send_string(f'{self.get_num_dropped()} sequences dropped')
+            else:
+                self.safe_send_string(addr, rep)
+        elif msg_str == "wait_status_change":
+            # long poll, the reply is sent once the status differs from 'last' or after 'timeout' seconds
+            self.status_waiters.append([addr, opts.get('last', ''),
+                                        time.monotonic() + opts.get('timeout', 10)])
         elif msg_str == "get_imgs":
-            rep = self.get_imgs()
+            rep = self.get_imgs(opts.get('version', 0), opts.get('max_seqs', 0),
+                                opts.get('max_bytes', 0), opts.get('compress'),
+                                opts.get('level', 1), self.__img_view(addr, opts))
             self.safe_send(addr, rep)
+        elif msg_str == "get_imgs_multipart":
+            frames = self.get_img_frames(opts.get('version', ImgFormat.VERSION),
+                                         opts.get('max_seqs', 0), opts.get('max_bytes', 0),
+                                         opts.get('compress'), opts.get('level', 1),
+                                         self.__img_view(addr, opts))
+            self.safe_send_multipart(addr, frames)
+        elif msg_str == "get_imgs_since":
+            info, frames = self.get_imgs_since(opts.get('index', 0), opts.get('version', ImgFormat.VERSION),
+                                               opts.get('max_seqs', 0), opts.get('max_bytes', 0),
+                                               opts.get('compress'), opts.get('level', 1),
+                                               self.__img_view(addr, opts))
+            self.safe_send_multipart(addr, [json.dumps(info).encode()] + frames)
+        elif msg_str == "set_roi":
+            # rois/binning applied to all the images fetched by this client from now on
+            view = ImgFormat.ImgView.from_opts(opts)
+            self.client_views.pop(addr[0], None)
+            if view is not None:
+                self.client_views[addr[0]] = view
+                while len(self.client_views) > self.max_client_views:
+                    del self.client_views[next(iter(self.client_views))]
+            self.safe_send_string(addr, "ok")
+        elif msg_str == "get_stats":
+            rep = self.get_stats()
+            self.safe_send_string(addr, json.dumps(rep))
+        elif msg_str == "get_compress_stats":
+            rep = self.get_compress_stats()
+            self.safe_send_string(addr, json.dumps(rep))
         elif msg_str == "get_seq_num":
             rep = self.get_seq_num()
             self.safe_send(addr, rep.to_bytes(8, 'little'))
         elif msg_str == "get_num_imgs":
             rep = self.get_num_imgs()
-            self.safe_send(addr, rep.to_bytes(8, 'little'))
+            if opts.get('dropped', False):
+                self.safe_send(addr, rep.to_bytes(8, 'little'), zmq.SNDMORE)
+                self.__sock.send(self.get_num_dropped().to_bytes(8, 'little'))
+            else:
+                self.safe_send(addr, rep.to_bytes(8, 'little'))
         elif msg_str == "get_config":
             datestr, timestr = self.get_config()
             self.safe_send_string(addr, datestr, zmq.SNDMORE)
             self.__sock.send_string(timestr)
         else:
-            self.safe_send_string(addr, f'')
+            self.safe_send_string(addr, '')
             return False
         return True
 
+    def __img_view(self, addr, opts):
+        # rois/binning of the request if it has any, otherwise the ones registered by the client
+        if 'roi' in opts or 'bin' in opts:
+            return ImgFormat.ImgView.from_opts(opts)
+        return self.client_views.get(addr[0])
+
     def safe_receive(func):
         def f(self):
             try:
@@ -152,47 +359,119 @@ class ExptServer(object):
     def safe_recv_string(self):
         return self.__sock.recv_string(zmq.NOBLOCK)
 
+    @safe_receive
+    def safe_recv_opts(self):
+        # optional json frame following the request string
+        if not self.__sock.getsockopt(zmq.RCVMORE):
+            return None
+        return json.loads(self.__sock.recv(zmq.NOBLOCK))
+
     def finish_recv(func):
         def f(self, *args, **kwargs):
-            # finish receiving messages
-            msg = self.safe_recv()
-            while msg is not None:
-                msg = self.safe_recv()
+            # finish receiving the remaining frames of the current message.
+            # Other queued requests are left alone so that they can still be handled.
+            while self.__sock.getsockopt(zmq.RCVMORE):
+                if self.safe_recv() is None:
+                    break
             func(self, *args, **kwargs)
         return f
 
+    def __send_envelope(self, addr):
+        # addr is the list of routing frames the request came with, followed by the empty delimiter
+        self.__sock.send_multipart(addr + [b''], zmq.SNDMORE)
+
     @finish_recv
     def safe_send_string(self, addr, msg_str, flag=0):
         # send reply
-        self.__sock.send(addr, zmq.SNDMORE)
-        self.__sock.send(b'', zmq.SNDMORE)
-        self.__sock.send_string(msg_str, flag)
+        self.__send_envelope(addr)
+        data = msg_str.encode('utf-8') # what send_string sends
+        self.__sock.send(data, flag)
+        self.bytes_sent += len(data)
         #print("Done sending")
 
     @finish_recv
     def safe_send(self, addr, msg, flag=0):
         # send reply
-        self.__sock.send(addr, zmq.SNDMORE)
-        self.__sock.send(b'', zmq.SNDMORE)
+        self.__send_envelope(addr)
         self.__sock.send(msg, flag)
+        self.bytes_sent += memoryview(msg).nbytes
+
+    @finish_recv
+    def safe_send_multipart(self, addr, frames):
+        # send reply with every frame as a separate zmq frame. copy=False hands the buffers to zmq
+        # directly, so the stored images are never concatenated or copied on our side.
+        self.__sock.send_multipart(addr + [b''] + frames, copy=False)
+        self.bytes_sent += sum(memoryview(frame).nbytes for frame in frames)
 
     def __check_worker_req(self):
         with self.__worker_lock:
             return self.__worker_req
 
+    def __handle_one(self) -> bool:
+        # handle one queued request, returns False if there was none
+        frame = self.safe_recv()
+        if frame is None:
+            return False
+        # routing envelope up to the empty delimiter. This is just the client identity for REQ
+        # clients and also includes the request id for DEALER clients (see AsyncAnalysisClient).
+        addr = []
+        while frame:
+            addr.append(frame)
+            if not self.__sock.getsockopt(zmq.RCVMORE):
+                break
+            frame = self.safe_recv()
+        msg_str = self.safe_recv_string()
+        if msg_str is None:
+            self.safe_send_string(addr, "Send more")
+        opts = self.safe_recv_opts()
+        t0 = time.perf_counter()
+        handled = self.handle_msg(addr, msg_str, opts)
+        self.latencies.append(time.perf_counter() - t0)
+        cmd = msg_str if handled else "unknown"
+        self.request_counts[cmd] = self.request_counts.get(cmd, 0) + 1
+        return True
+
     def __worker_func(self):
-        # worker function
-        while self.__check_worker_req() != self.WorkerRequest.Stop:
-            if self.__sock.poll(self.timeout) == 0: # in milliseconds
-                continue
-            addr = self.safe_recv()
-            delimit = self.safe_recv_string()
-            msg_str = self.safe_recv_string()
-            if msg_str is None:
-                self.safe_send_string(addr, "Send more")
-            self.handle_msg(addr, msg_str)
+        # worker function. Sleeps until either a client request or a control message arrives.
+        poller = zmq.Poller()
+        poller.register(self.__sock, zmq.POLLIN)
+        poller.register(self.__ctrl_recv, zmq.POLLIN)
+        while True:
+            timeout = None
+            if self.status_waiters:
+                deadline = min(waiter[2] for waiter in self.status_waiters)
+                timeout = max(0, (deadline - time.monotonic()) * 1000)
+            events = dict(poller.poll(timeout))
+            if self.__ctrl_recv in events:
+                self.__ctrl_recv.recv()
+                if self.__check_worker_req() == self.WorkerRequest.Stop:
+                    break
+            if self.__sock in events:
+                # drain a batch of queued requests before going back to sleep
+                for i in range(self.max_batch):
+                    if not self.__handle_one():
+                        break
+            self.__reply_status_waiters()
         print("Worker finishing")
 
+    def __reply_status_waiters(self):
+        if not self.status_waiters:
+            return
+        status = self.get_status()
+        now = time.monotonic()
+        waiters = []
+        for waiter in self.status_waiters:
+            if waiter[1] != status or now >= waiter[2]:
+                self.safe_send_string(waiter[0], status)
+            else:
+                waiters.append(waiter)
+        self.status_waiters = waiters
+
+    def __notify_worker(self):
+        # wake up the worker after the status changed from the expt thread
+        if self.worker_running():
+            self.__ctrl_send.send(b'')
+
     # functions for either thread but mostly for the msg handler
     def pause_seq(self) -> str:
         with self.__data_lock:
@@ -228,14 +507,6 @@ class ExptServer(object):
                 res = "Sequence status is unknown"
         return res
 
-    def pop_img(self):
-        with self.__data_lock:
-            try:
-                res = self.imgs.pop()
-            except:
-                res = None
-        return res
-
     def get_seq_num(self) -> int:
         with self.__data_lock:
             return self.nseq
@@ -244,36 +515,155 @@ class ExptServer(object):
         with self.__data_lock:
             return self.nseq_imgs
 
+    def get_num_dropped(self) -> int:
+        with self.__data_lock:
+            return self.ndropped
+
     def get_config(self):
         with self.__data_lock:
             return self.dateStamp, self.timeStamp
 
-    def get_imgs(self):
+    def pop_seqs(self, max_seqs=0, max_bytes=0):
+        # take out finished sequences, oldest first, until max_seqs sequences or max_bytes bytes
+        # have been collected (0 means no limit). At least one sequence is returned if there is
+        # any so that a single sequence larger than max_bytes can still be fetched.
+        # returns the sequences and whether more sequences are still queued.
+        seqs = []
+        nbytes = 0
+        with self.__data_lock:
+            while max_seqs <= 0 or len(seqs) < max_seqs:
+                if not self.imgs:
+                    # swap out. self.imgs only holds sequences older than self.expt_imgs
+                    with self.__expt_lock:
+                        if not self.expt_imgs:
+                            break
+                        self.expt_imgs, self.imgs = self.imgs, self.expt_imgs
+                seq_bytes = self.imgs[-1].nbytes
+                if seqs and max_bytes > 0 and nbytes + seq_bytes > max_bytes:
+                    break
+                seq = self.imgs.pop()
+                if seq.spilled and self.__spill is not None:
+                    self.__spill.release(seq)
+                seqs.append(seq)
+                nbytes = nbytes + seq_bytes
+            self.nseq_imgs = self.nseq_imgs - len(seqs)
+            self.nbytes_imgs = self.nbytes_imgs - nbytes
+            more = self.nseq_imgs > 0
+            self.__space_cond.notify_all()
+        return seqs, more
+
+    def get_imgs(self, version=0, max_seqs=0, max_bytes=0, compress=None, level=1, view=None):
         # returns bytes to be sent across the network
-        # intended format: [nseqs: double][[scan_id: double][seq_id: double][shape_x: double, shape_y: double, nimgs: double, data: shape_x * shape_y * nimgs * sizeof(double)] x num_transfers_per_seq] [<0>:double] x nseqs]
-        # 0 separates out sequences
-        n_transfer = 0
-        zero_array = array.array('d', [0])
-        res = bytearray()
-        #if nseqs < 0:
-        nseqs = self.get_num_imgs()
-        nseqs_array = array.array('d', [nseqs])
-        res.extend(nseqs_array.tobytes())
-        #swap out. Assume self.imgs has been cleared out already
-        if nseqs > 0:
-            with self.__data_lock:
-                with self.__expt_lock:
-                    self.expt_imgs, self.imgs = self.imgs, self.expt_imgs
-            while n_transfer < nseqs:
-                next_img = self.pop_img()
-                while next_img != b'':
-                    res.extend(next_img.tobytes())
-                    next_img = self.pop_img()
-                res.extend(zero_array.tobytes())
-                n_transfer = n_transfer + 1
-            with self.__data_lock:
-                self.nseq_imgs = self.nseq_imgs - n_transfer
-        return res
+        # version 0 is the legacy all float64 format, otherwise the typed format (see ImgFormat)
+        # in the typed format, the FLAG_MORE flag is set if the limits left sequences in the queue
+        # and the pixel data can be compressed ('zlib' or 'lzma' at the given level)
+        # view (an ImgFormat.ImgView) crops and bins the images first
+        seqs, more = self.pop_seqs(max_seqs, max_bytes)
+        if view is not None:
+            seqs = [view.apply(seq) for seq in seqs]
+        if version <= 0:
+            return ImgFormat.encode_legacy(seqs)
+        flags = ImgFormat.FLAG_MORE if more else 0
+        return ImgFormat.encode(seqs, min(version, ImgFormat.VERSION), flags,
+                                compress, level, self.compress_stats)
+
+    def get_img_frames(self, version=ImgFormat.VERSION, max_seqs=0, max_bytes=0,
+                       compress=None, level=1, view=None):
+        # returns a list of frames to be sent as one multipart message in the typed format.
+        # every header and every block of pixel data is its own frame so the stored images
+        # are never concatenated.
+        seqs, more = self.pop_seqs(max_seqs, max_bytes)
+        if view is not None:
+            seqs = [view.apply(seq) for seq in seqs]
+        flags = ImgFormat.FLAG_MORE if more else 0
+        return ImgFormat.encode_frames(seqs, min(max(version, 1), ImgFormat.VERSION), flags,
+                                       compress, level, self.compress_stats)
+
+    def get_stats(self):
+        # server performance metrics, should only be called from the worker
+        with self.__data_lock:
+            queue = {'nseqs': self.nseq_imgs, 'nbytes': self.nbytes_imgs, 'ndropped': self.ndropped}
+        latencies = sorted(self.latencies)
+        percentiles = {}
+        for p in (50, 90, 99, 100):
+            if latencies:
+                percentiles[f'p{p}'] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+            else:
+                percentiles[f'p{p}'] = 0.0
+        return {'queue': queue,
+                'bytes_sent': self.bytes_sent,
+                'requests': dict(self.request_counts),
+                'latency': percentiles,
+                'data_lock': self.__data_lock.get_stats(),
+                'expt_lock': self.__expt_lock.get_stats(),
+                'compression': self.compress_stats.to_dict()}
+
+    def get_imgs_since(self, index, version=ImgFormat.VERSION, max_seqs=0, max_bytes=0,
+                       compress=None, level=1, view=None):
+        # non-destructive read of the sequences in the log starting at index, within the same limits as get_imgs.
+        # returns a dict with the index to read from next time ('next'), the oldest index
+        # still retained ('first', if it is larger than the requested index sequences were missed),
+        # the index the next finished sequence gets ('end') and whether index was past it ('reset'),
+        # and the frames of the sequences in the typed format.
+        # An index past the end comes from a cursor of an earlier server session, the log is then
+        # read from first again.
+        seqs = []
+        nbytes = 0
+        with self.__data_lock:
+            self.__trim_log()
+            first = self.log_start
+            end = self.log_start + len(self.img_log)
+            reset = int(index) > end
+            idx = first if reset else max(int(index), first)
+            while idx < end and (max_seqs <= 0 or len(seqs) < max_seqs):
+                seq = self.img_log[idx - first][1]
+                if seqs and max_bytes > 0 and nbytes + seq.nbytes > max_bytes:
+                    break
+                seqs.append(seq)
+                nbytes = nbytes + seq.nbytes
+                idx = idx + 1
+        flags = ImgFormat.FLAG_MORE if idx < end else 0
+        if view is not None:
+            seqs = [view.apply(seq) for seq in seqs]
+        frames = ImgFormat.encode_frames(seqs, min(max(version, 1), ImgFormat.VERSION), flags,
+                                         compress, level, self.compress_stats)
+        return {'next': idx, 'first': first, 'end': end, 'reset': reset}, frames
+
+    def set_log_retention(self, max_seqs=0, max_bytes=0, max_age=0, keep_queue=True):
+        # keep the last max_seqs sequences/max_bytes bytes/max_age seconds of sequences in the
+        # log read by get_imgs_since (0 means no limit, all 0 turns the log off).
+        # if keep_queue is False, logged sequences are not queued for get_imgs.
+        with self.__data_lock:
+            self.log_max_seqs = int(max_seqs)
+            self.log_max_bytes = int(max_bytes)
+            self.log_max_age = float(max_age)
+            self.__trim_log()
+        self.keep_queue = bool(keep_queue)
+
+    def __log_enabled(self) -> bool:
+        return self.log_max_seqs > 0 or self.log_max_bytes > 0 or self.log_max_age > 0
+
+    def __trim_log(self):
+        # call with __data_lock held
+        if not self.__log_enabled():
+            self.log_start = self.log_start + len(self.img_log)
+            self.img_log.clear()
+            self.log_bytes = 0
+            return
+        now = time.time()
+        while self.img_log:
+            t, seq = self.img_log[0]
+            if not ((self.log_max_seqs > 0 and len(self.img_log) > self.log_max_seqs) or
+                    (self.log_max_bytes > 0 and self.log_bytes > self.log_max_bytes) or
+                    (self.log_max_age > 0 and now - t > self.log_max_age)):
+                break
+            self.img_log.popleft()
+            self.log_start = self.log_start + 1
+            self.log_bytes = self.log_bytes - seq.nbytes
+
+    def get_compress_stats(self):
+        # compression ratio and CPU time of the images sent so far
+        return self.compress_stats.to_dict()
 
     # this one is only for msg handler
     def start_seq_serv(self) -> str:
@@ -299,28 +689,104 @@ class ExptServer(object):
         #clear abort or pause if exists
         with self.__seq_lock:
             self.__seq_req = self.SeqRequest.NoRequest
+        self.__notify_worker()
         scan_id = round(time.time() * 1000) # assuming scans aren't started within ms of each other... We'll send over as 64 bits over the network
         return scan_id
 
+    def __store_block(self, block, scan_id, seq_id):
+        if self.temp_imgs is None:
+            self.temp_imgs = ImgFormat.SeqImgs(scan_id, seq_id)
+        self.temp_imgs.blocks.append(block)
+
     def store_imgs(self, data, scan_id=-1, seq_id=-1):
-        # need to make data an array, so tobytes can be called
-        if not self.temp_imgs: # check it temp_imgs is empty
-            self.temp_imgs.append(array.array('d', [scan_id]))
-            self.temp_imgs.append(array.array('d', [seq_id]))
-        self.temp_imgs.append(data)
+        # data is [shape_x, shape_y, nimgs, pixels...] as doubles
+        self.__store_block(ImgFormat.ImgBlock.from_legacy(data), scan_id, seq_id)
+
+    def store_typed_imgs(self, data, shape, scan_id=-1, seq_id=-1):
+        # data is the flattened pixels in their native dtype, e.g. array('H') for uint16 images
+        self.__store_block(ImgFormat.ImgBlock.from_buffer(data, shape), scan_id, seq_id)
+
+    def store_imgs_buffer(self, data, shape, dtype=None, scan_id=-1, seq_id=-1, copy=False):
+        # data is any buffer protocol or numpy object with the pixels in column major order.
+        # dtype (a MATLAB class name or format character) overrides the format of data.
+        # A reference to data is kept, so set copy if the caller is going to reuse the buffer.
+        block = ImgFormat.ImgBlock.from_buffer(data, shape, dtype, copy)
+        self.__store_block(block, scan_id, seq_id)
+
+    def set_queue_limits(self, max_seqs=0, max_bytes=0, policy=0, timeout=1.0):
+        # max_seqs/max_bytes of 0 means no limit. policy is an OverflowPolicy value,
+        # timeout is how long (in seconds) the Block policy waits before dropping the new sequence.
+        with self.__data_lock:
+            self.max_seqs = int(max_seqs)
+            self.max_bytes = int(max_bytes)
+            self.overflow_policy = self.OverflowPolicy(int(policy))
+            self.block_timeout = float(timeout)
+
+    def __queue_full(self, nbytes) -> bool:
+        # call with __data_lock held
+        if self.max_seqs > 0 and self.nseq_imgs + 1 > self.max_seqs:
+            return True
+        if self.max_bytes > 0 and self.nbytes_imgs + nbytes > self.max_bytes:
+            return True
+        return False
+
+    def __drop_oldest(self) -> bool:
+        # call with __data_lock and __expt_lock held. self.imgs holds older sequences than self.expt_imgs
+        if self.imgs:
+            seq = self.imgs.pop()
+        elif self.expt_imgs:
+            seq = self.expt_imgs.pop()
+        else:
+            return False
+        if seq.spilled and self.__spill is not None:
+            self.__spill.release(seq)
+        self.nseq_imgs = self.nseq_imgs - 1
+        self.nbytes_imgs = self.nbytes_imgs - seq.nbytes
+        self.ndropped = self.ndropped + 1
+        return True
 
     def seq_finish(self):
+        seq = self.temp_imgs
+        if seq is None:
+            seq = ImgFormat.SeqImgs(-1, -1)
+        self.temp_imgs = None
+        nbytes = seq.nbytes
+        if self.__pub_sock is not None:
+            self.publish_seq(seq)
         with self.__data_lock:
             self.nseq = self.nseq + 1
-            self.nseq_imgs = self.nseq_imgs + 1
+            logged = self.__log_enabled()
+            if logged:
+                self.img_log.append((time.time(), seq))
+                self.log_bytes = self.log_bytes + nbytes
+                self.__trim_log()
+            if not self.keep_queue and (logged or self.__pub_sock is not None):
+                return
+            if self.overflow_policy == self.OverflowPolicy.Block:
+                self.__space_cond.wait_for(lambda: not self.__queue_full(nbytes),
+                                           self.block_timeout)
+            with self.__expt_lock:
+                if self.overflow_policy == self.OverflowPolicy.DropOldest:
+                    while self.__queue_full(nbytes) and self.__drop_oldest():
+                        pass
+                elif self.__queue_full(nbytes):
+                    # DropNewest, or Block timed out
+                    self.ndropped = self.ndropped + 1
+                    return
+            spill = self.__spill
+        if spill is not None:
+            # the queue then only references the memory mapped copy on disk. Writing it can take a
+            # while, so the worker isn't kept waiting for the locks meanwhile. Only this thread adds
+            # to the queue, so there is still space for seq afterwards.
+            seq = spill.append(seq)
+        with self.__data_lock:
             with self.__expt_lock:
-                for data in self.temp_imgs:
-                    self.expt_imgs.appendleft(data)
-                self.expt_imgs.appendleft(b'')
-        self.temp_imgs.clear()
+                self.nseq_imgs = self.nseq_imgs + 1
+                self.nbytes_imgs = self.nbytes_imgs + nbytes
+                self.expt_imgs.appendleft(seq)
 
     def seq_cancel(self):
-        self.temp_imgs.clear()
+        self.temp_imgs = None
 
     def set_config(self, date: str, time: str):
         with self.__data_lock:
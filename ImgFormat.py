@@ -0,0 +1,477 @@
+import struct
+import array
+import time
+import zlib
+import lzma
+
+# Binary image format shared between ExptServer and AnalysisClient.
+#
+# Legacy format (no version requested): everything is packed as float64
+# [nseqs][[scan_id][seq_id][shape_x, shape_y, nimgs, data...] x nblocks [0]] x nseqs
+#
+# Typed format (version >= 1): little endian packed structs, pixel data kept in its native dtype
+# stream: [magic: 4s = b'NIMG'][version: uint16][flags: uint16][nseqs: uint32] [seq] x nseqs
+# seq:    [scan_id: int64][seq_id: int64][nblocks: uint32] [block] x nblocks
+# block:  [dtype: uint8][compression: uint8][pad: 2x][shape_x: uint32][shape_y: uint32][nimgs: uint32]
+#         ([compressed size: uint64] if compression != 0) [data: shape_x * shape_y * nimgs * itemsize or compressed size]
+# The compression byte was padding in version 1 and is always 0 there.
+# Each header and each block of pixel data is an independent chunk, so the stream can either be
+# concatenated into a single buffer or sent with each chunk as its own zmq frame.
+
+MAGIC = b'NIMG'
+VERSION = 2
+
+# stream flags
+FLAG_MORE = 1 # more sequences are available on the server
+
+stream_header = struct.Struct('<4sHHI')
+seq_header = struct.Struct('<qqI')
+block_header = struct.Struct('<BB2xIII')
+compressed_size = struct.Struct('<Q')
+
+# compression codes, the low 4 bits select the method,
+# SHUFFLED is set if the bytes were shuffled (grouped by significance) before compressing
+compressions = {0: None, 1: 'zlib', 2: 'lzma'}
+compression_codes = {name: code for code, name in compressions.items()}
+SHUFFLED = 0x10
+
+# dtype code -> (array typecode, MATLAB class name)
+dtypes = {
+    1: ('d', 'double'),
+    2: ('f', 'single'),
+    3: ('B', 'uint8'),
+    4: ('b', 'int8'),
+    5: ('H', 'uint16'),
+    6: ('h', 'int16'),
+    7: ('I', 'uint32'),
+    8: ('i', 'int32'),
+    9: ('Q', 'uint64'),
+    10: ('q', 'int64'),
+}
+# (kind, itemsize) -> dtype code
+_codes = {}
+for _code, (_typecode, _name) in dtypes.items():
+    _kind = 'f' if _typecode in 'df' else ('u' if _typecode.isupper() else 'i')
+    _codes[(_kind, struct.calcsize(_typecode))] = _code
+
+def dtype_code(fmt: str) -> int:
+    # map a buffer protocol format string (e.g. 'H' or '<H') to a dtype code
+    fmt = fmt.lstrip('@=<')
+    if len(fmt) != 1 or fmt not in 'dfbBhHiIlLqQ':
+        raise ValueError("Unsupported image format '%s'" % fmt)
+    kind = 'f' if fmt in 'df' else ('u' if fmt.isupper() else 'i')
+    return _codes[(kind, struct.calcsize(fmt))]
+
+def dtype_from_name(name: str) -> int:
+    # dtype code from a MATLAB class name (e.g. 'uint16') or a buffer protocol format (e.g. 'H')
+    for code, (typecode, matlab_name) in dtypes.items():
+        if name == matlab_name:
+            return code
+    return dtype_code(name)
+
+def as_bytes(data):
+    # flat byte view of any buffer protocol object without copying.
+    # Only non C-contiguous (e.g. Fortran ordered numpy) arrays are copied, keeping their memory order.
+    view = memoryview(data)
+    if not view.c_contiguous:
+        view = memoryview(view.tobytes('A'))
+    return view.cast('B')
+
+def to_array(data):
+    # copy of a typed buffer (e.g. ImgBlock.data) as an array.array for MATLAB, which only converts
+    # memoryviews with double() from R2022a on but array.array on every release
+    view = memoryview(data)
+    res = array.array(view.format.lstrip('@=<'))
+    res.frombytes(as_bytes(view))
+    return res
+
+def shuffle(buf, itemsize: int) -> bytes:
+    # group byte i of every item together, so the mostly constant high bytes of integer pixels compress well
+    view = as_bytes(buf)
+    return b''.join(view[i::itemsize].tobytes() for i in range(itemsize))
+
+def unshuffle(buf, itemsize: int) -> bytearray:
+    view = as_bytes(buf)
+    n = len(view) // itemsize
+    res = bytearray(len(view))
+    for i in range(itemsize):
+        res[i::itemsize] = view[i * n:(i + 1) * n]
+    return res
+
+class CompressStats(object):
+    # compression ratio and CPU time spent (de)compressing
+    def __init__(self):
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0 # in seconds
+        self.decompress_time = 0.0 # in seconds
+
+    @property
+    def ratio(self) -> float:
+        if self.compressed_bytes == 0:
+            return 1.0
+        return self.raw_bytes / self.compressed_bytes
+
+    def to_dict(self):
+        return {'raw_bytes': self.raw_bytes, 'compressed_bytes': self.compressed_bytes,
+                'ratio': self.ratio, 'compress_time': self.compress_time,
+                'decompress_time': self.decompress_time}
+
+def compress(buf, method: str, level=1, itemsize=1, stats=None):
+    # returns the compression code and the compressed bytes.
+    # Integer data with more than one byte per item are shuffled first.
+    t0 = time.thread_time()
+    code = compression_codes[method]
+    data = as_bytes(buf)
+    if itemsize > 1:
+        data = shuffle(data, itemsize)
+        code = code | SHUFFLED
+    if method == 'zlib':
+        res = zlib.compress(data, level)
+    else:
+        res = lzma.compress(data, preset=level)
+    if stats is not None:
+        stats.raw_bytes += len(data)
+        stats.compressed_bytes += len(res)
+        stats.compress_time += time.thread_time() - t0
+    return code, res
+
+def decompress(buf, code: int, itemsize=1, stats=None):
+    t0 = time.thread_time()
+    method = compressions.get(code & 0xf)
+    if method == 'zlib':
+        res = zlib.decompress(buf)
+    elif method == 'lzma':
+        res = lzma.decompress(buf)
+    else:
+        raise ValueError("Unknown compression %d" % code)
+    if code & SHUFFLED:
+        res = unshuffle(res, itemsize)
+    if stats is not None:
+        stats.raw_bytes += len(res)
+        stats.compressed_bytes += len(buf)
+        stats.decompress_time += time.thread_time() - t0
+    return res
+
+class CompressOpts(object):
+    # compression a client applies to (or asks the server for) the images and the statistics of it.
+    # Mixin of the experiment and analysis clients, which call init_compression from __init__.
+    def init_compression(self):
+        self.compress = None # 'zlib', 'lzma' or None
+        self.compress_level = 1
+        self.compress_stats = CompressStats()
+
+    def set_compression(self, method=None, level=1):
+        # method is 'zlib', 'lzma' or None/'' for no compression
+        self.compress = method if method else None
+        self.compress_level = int(level)
+
+    def get_compress_stats(self):
+        return self.compress_stats.to_dict()
+
+class ImgRequestOpts(CompressOpts):
+    # options sent with the typed image requests of the analysis clients.
+    # Mixin, the clients call init_img_opts from __init__.
+    def init_img_opts(self):
+        self.init_compression()
+        # 'roi' and 'bin' set with set_roi, sent with every image request so they survive recreate_sock
+        self.view_opts = {}
+
+    def set_view_opts(self, rois=None, binning=1):
+        self.view_opts = {'roi': rois if rois else [], 'bin': binning}
+        return self.view_opts
+
+    def img_opts(self, **kwargs):
+        opts = {'version': VERSION}
+        if self.compress is not None:
+            opts['compress'] = self.compress
+            opts['level'] = self.compress_level
+        opts.update(self.view_opts)
+        opts.update(kwargs)
+        return opts
+
+class ImgBlock(object):
+    # a stack of nimgs images of shape_x x shape_y pixels stored in their native dtype
+    def __init__(self, dtype: int, shape, data):
+        self.dtype = dtype
+        self.shape = tuple(int(s) for s in shape)
+        self.data = data
+
+    @classmethod
+    def from_legacy(cls, data):
+        # data is [shape_x, shape_y, nimgs, pixels...] as doubles
+        view = memoryview(data)
+        if view.format != 'd':
+            view = memoryview(array.array('d', data))
+        return cls(1, view[:3].tolist(), view[3:])
+
+    @classmethod
+    def from_buffer(cls, data, shape, dtype=None, copy=False):
+        # data is any buffer protocol object (array, numpy array, bytes, ...) holding the pixels in
+        # column major order. dtype overrides the format of the buffer, e.g. for raw bytes.
+        # A reference to data is kept unless copy is True, in which case it is copied exactly once.
+        view = memoryview(data)
+        code = dtype_code(view.format) if dtype is None else dtype_from_name(dtype)
+        shape = [int(s) for s in shape]
+        if len(shape) == 2:
+            shape.append(1)
+        typecode = dtypes[code][0]
+        view = as_bytes(view)
+        if len(view) != shape[0] * shape[1] * shape[2] * struct.calcsize(typecode):
+            raise ValueError("Image data does not match shape %s" % (shape,))
+        if copy:
+            view = memoryview(bytearray(view))
+        return cls(code, shape, view.cast(typecode))
+
+    @property
+    def typecode(self) -> str:
+        return dtypes[self.dtype][0]
+
+    @property
+    def dtype_name(self) -> str:
+        return dtypes[self.dtype][1]
+
+    @property
+    def nbytes(self) -> int:
+        return memoryview(self.data).nbytes
+
+    @property
+    def itemsize(self) -> int:
+        return struct.calcsize(self.typecode)
+
+    def header(self, compression=0) -> bytes:
+        return block_header.pack(self.dtype, compression, *self.shape)
+
+    def frames(self, method=None, level=1, stats=None):
+        # header and payload chunks of this block, optionally compressed with method
+        if method is None:
+            return [self.header(), as_bytes(self.data)]
+        # only integer pixels are shuffled
+        itemsize = 1 if self.typecode in 'df' else self.itemsize
+        code, data = compress(self.data, method, level, itemsize, stats)
+        return [self.header(code) + compressed_size.pack(len(data)), data]
+
+    def to_ndarray(self):
+        # zero-copy numpy array of shape (shape_x, shape_y, nimgs) in column major order
+        import numpy as np
+        return np.frombuffer(self.data, dtype=self.typecode).reshape(self.shape, order='F')
+
+    def to_double(self):
+        # pixel data widened to float64, only used for the legacy format
+        view = memoryview(self.data)
+        if self.dtype == 1:
+            return view
+        return memoryview(array.array('d', view.cast('B').cast(self.typecode)))
+
+def img_array(data):
+    # [shape, imgdata] as received by the analysis servers to a (shape_x, shape_y, nimgs) numpy array
+    if data is None:
+        return None
+    shape, imgdata = data
+    return ImgBlock.from_buffer(imgdata, [int(s) for s in shape]).to_ndarray()
+
+class SeqImgs(object):
+    # all image blocks stored during one sequence
+    def __init__(self, scan_id: int, seq_id: int, blocks=None):
+        self.scan_id = int(scan_id)
+        self.seq_id = int(seq_id)
+        self.blocks = [] if blocks is None else blocks
+        self.spilled = False # the pixel data lives in a SpillStore
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.nbytes for block in self.blocks)
+
+    def header(self) -> bytes:
+        return seq_header.pack(self.scan_id, self.seq_id, len(self.blocks))
+
+    def to_ndarray(self):
+        # all the images of the sequence as one (shape_x, shape_y, nimgs) numpy array.
+        # Zero-copy if there is only one block, otherwise the blocks are concatenated.
+        import numpy as np
+        if len(self.blocks) == 1:
+            return self.blocks[0].to_ndarray()
+        if not self.blocks:
+            return np.zeros((0, 0, 0))
+        return np.concatenate([block.to_ndarray() for block in self.blocks], axis=2)
+
+    def to_tuple(self):
+        return (self.scan_id, self.seq_id, self.to_ndarray())
+
+def sum_dtype(dtype, n):
+    # smallest integer numpy dtype of the same signedness that holds the sum of n pixels of dtype
+    import numpy as np
+    info = np.iinfo(dtype)
+    types = (np.uint8, np.uint16, np.uint32, np.uint64) if info.min == 0 else (np.int8, np.int16, np.int32, np.int64)
+    for t in types:
+        tinfo = np.iinfo(t)
+        if tinfo.min <= info.min * n and info.max * n <= tinfo.max:
+            return np.dtype(t)
+    return np.dtype(types[-1])
+
+class ImgView(object):
+    # cropping to regions of interest and binning applied to the images before they are sent.
+    # rois are [x0, x1, y0, y1], 0-based with the end excluded, and every roi of every block becomes
+    # its own block. binning sums binning x binning pixels (leftover edge pixels are dropped),
+    # integer pixels are summed in the smallest integer type that can't overflow.
+    def __init__(self, rois=None, binning=1):
+        self.rois = [[int(v) for v in roi] for roi in rois] if rois else []
+        self.binning = max(int(binning), 1)
+
+    @classmethod
+    def from_opts(cls, opts):
+        # None if opts ('roi' and 'bin') leave the images as they are
+        view = cls(opts.get('roi'), opts.get('bin', 1))
+        if not view.rois and view.binning == 1:
+            return None
+        return view
+
+    def apply_block(self, block):
+        import numpy as np
+        imgs = block.to_ndarray()
+        rois = self.rois if self.rois else [[0, block.shape[0], 0, block.shape[1]]]
+        b = self.binning
+        res = []
+        for x0, x1, y0, y1 in rois:
+            sub = imgs[max(x0, 0):x1, max(y0, 0):y1, :]
+            if b > 1:
+                nx = sub.shape[0] // b
+                ny = sub.shape[1] // b
+                dtype = sub.dtype if sub.dtype.kind == 'f' else sum_dtype(sub.dtype, b * b)
+                sub = sub[:nx * b, :ny * b, :].reshape((b, nx, b, ny, sub.shape[2]), order='F')
+                sub = sub.sum(axis=(0, 2), dtype=dtype)
+            sub = np.asfortranarray(sub)
+            res.append(ImgBlock.from_buffer(sub.ravel(order='F'), sub.shape))
+        return res
+
+    def apply(self, seq):
+        # new SeqImgs, the pixel data of seq is left alone
+        blocks = []
+        for block in seq.blocks:
+            blocks.extend(self.apply_block(block))
+        return SeqImgs(seq.scan_id, seq.seq_id, blocks)
+
+def encode_frames(seqs, version=VERSION, flags=0, compress=None, level=1, stats=None):
+    # list of chunks in the typed format. Uncompressed pixel data is referenced, not copied.
+    # compression ('zlib' or 'lzma') needs version >= 2 and is ignored otherwise.
+    if version < 2:
+        compress = None
+    frames = [stream_header.pack(MAGIC, version, flags, len(seqs))]
+    for seq in seqs:
+        frames.extend(seq_frames(seq, compress, level, stats))
+    return frames
+
+def seq_frames(seq, compress=None, level=1, stats=None):
+    # chunks of a single sequence record
+    frames = [seq.header()]
+    for block in seq.blocks:
+        frames.extend(block.frames(compress, level, stats))
+    return frames
+
+def encode(seqs, version=VERSION, flags=0, compress=None, level=1, stats=None):
+    return b''.join(encode_frames(seqs, version, flags, compress, level, stats))
+
+def encode_legacy(seqs):
+    res = bytearray()
+    res.extend(array.array('d', [len(seqs)]).tobytes())
+    zero = array.array('d', [0]).tobytes()
+    for seq in seqs:
+        if seq.blocks:
+            res.extend(array.array('d', [seq.scan_id, seq.seq_id]).tobytes())
+        for block in seq.blocks:
+            res.extend(array.array('d', block.shape).tobytes())
+            res.extend(block.to_double())
+        res.extend(zero)
+    return res
+
+def decode_legacy(buf):
+    # split the legacy float64 stream into a list of SeqImgs without copying the pixel data.
+    # Sequences without images are skipped.
+    data = as_bytes(getattr(buf, 'buffer', buf)).cast('d')
+    if len(data) == 0:
+        return []
+    seqs = []
+    idx = 1
+    for i in range(int(data[0])):
+        if idx >= len(data):
+            raise ValueError("Truncated image data")
+        if data[idx] == 0:
+            # end of an empty sequence
+            idx += 1
+            continue
+        seq = SeqImgs(data[idx], data[idx + 1])
+        idx += 2
+        while True:
+            if idx >= len(data):
+                raise ValueError("Truncated image data")
+            if data[idx] == 0:
+                break
+            sx, sy, nimgs = (int(v) for v in data[idx:idx + 3])
+            idx += 3
+            npixels = sx * sy * nimgs
+            if idx + npixels > len(data):
+                raise ValueError("Truncated image data")
+            seq.blocks.append(ImgBlock(1, (sx, sy, nimgs), data[idx:idx + npixels]))
+            idx += npixels
+        idx += 1
+        seqs.append(seq)
+    return seqs
+
+class _Reader(object):
+    # reads consecutive chunks from a list of buffers, no chunk may span two buffers
+    def __init__(self, bufs):
+        self.bufs = [as_bytes(getattr(buf, 'buffer', buf)) for buf in bufs]
+        self.idx = 0
+        self.offset = 0
+
+    def read(self, n: int):
+        while self.offset >= len(self.bufs[self.idx]) and n > 0:
+            if self.idx + 1 >= len(self.bufs):
+                raise ValueError("Truncated image data")
+            self.idx += 1
+            self.offset = 0
+        buf = self.bufs[self.idx]
+        if self.offset + n > len(buf):
+            raise ValueError("Truncated image data")
+        res = buf[self.offset:self.offset + n]
+        self.offset += n
+        return res
+
+def _decode_seq(reader, stats=None):
+    scan_id, seq_id, nblocks = seq_header.unpack(reader.read(seq_header.size))
+    seq = SeqImgs(scan_id, seq_id)
+    for j in range(nblocks):
+        dtype, compression, sx, sy, nimgs = block_header.unpack(reader.read(block_header.size))
+        if dtype not in dtypes:
+            raise ValueError("Unknown image dtype %d" % dtype)
+        typecode = dtypes[dtype][0]
+        itemsize = struct.calcsize(typecode)
+        if compression == 0:
+            data = reader.read(sx * sy * nimgs * itemsize)
+        else:
+            nbytes, = compressed_size.unpack(reader.read(compressed_size.size))
+            data = memoryview(decompress(reader.read(nbytes), compression, itemsize, stats))
+        seq.blocks.append(ImgBlock(dtype, (sx, sy, nimgs), data.cast(typecode)))
+    return seq
+
+def decode_seq(buf, stats=None):
+    # decode a single sequence record (as produced by seq_frames)
+    return _decode_seq(_Reader([buf]), stats)
+
+def decode(bufs, stats=None):
+    return decode_stream(bufs, stats)[1]
+
+def decode_stream(bufs, stats=None):
+    # decode the typed format from a single buffer or a list of zmq frames/buffers.
+    # returns the stream flags and the list of SeqImgs.
+    # The pixel data of the returned blocks are memoryviews into the input buffers.
+    if not isinstance(bufs, (list, tuple)):
+        bufs = [bufs]
+    reader = _Reader(bufs)
+    magic, version, flags, nseqs = stream_header.unpack(reader.read(stream_header.size))
+    if magic != MAGIC:
+        raise ValueError("Not a typed image stream")
+    if version > VERSION:
+        raise ValueError("Unsupported image format version %d" % version)
+    seqs = [_decode_seq(reader, stats) for i in range(nseqs)]
+    return flags, seqs
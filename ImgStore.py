@@ -0,0 +1,245 @@
+import os
+import mmap
+import struct
+import threading
+import ImgFormat
+
+class SpillStore(object):
+    # Append-only on disk store for the finished sequences of ExptServer.
+    # Each scan gets its own set of files in path:
+    #   scan_<scan_id>.seg: sequence records (ImgFormat.seq_frames, uncompressed) appended back to back
+    #   scan_<scan_id>.idx: [offset: uint64][nbytes: uint64] for every record in the segment
+    #   scan_<scan_id>.pos: [nreleased: uint64] number of records already fetched, replaced atomically
+    # Records are read back through a memory map of just that record, which lives as long as the
+    # SeqImgs using it, so the pixel data doesn't need to be loaded into memory and the mapped size
+    # follows the backlog rather than the segment. The records that were not released survive a
+    # crash or restart.
+    # append can be called from one thread while another one releases records.
+    index_entry = struct.Struct('<QQ')
+    release_pos = struct.Struct('<Q')
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.__nrecords = {} # scan_id -> number of records in the segment
+        self.__nreleased = {} # scan_id -> number of records released
+        self.__last_scan = None # scan that was appended to last
+        self.__lock = threading.Lock() # protects the record counts above
+
+    def __file(self, scan_id: int, ext: str) -> str:
+        return os.path.join(self.path, f'scan_{scan_id}.{ext}')
+
+    def __scan_ids(self):
+        scan_ids = []
+        for name in os.listdir(self.path):
+            if name.startswith('scan_') and name.endswith('.idx'):
+                try:
+                    scan_ids.append(int(name[5:-4]))
+                except ValueError:
+                    pass
+        return sorted(scan_ids)
+
+    def __load(self, scan_id: int, offset: int, nbytes: int):
+        # the mapping has to start at a multiple of the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with open(self.__file(scan_id, 'seg'), 'rb') as fh:
+            m = mmap.mmap(fh.fileno(), offset + nbytes - start, access=mmap.ACCESS_READ, offset=start)
+        seq = ImgFormat.decode_seq(memoryview(m)[offset - start:])
+        seq.spilled = True
+        return seq
+
+    def append(self, seq):
+        # write seq to disk and return an equivalent SeqImgs backed by the memory mapped segment
+        scan_id = seq.scan_id
+        with self.__lock:
+            # keeps cleanup away from the files we are writing
+            self.__last_scan = scan_id
+        with open(self.__file(scan_id, 'seg'), 'ab') as fh:
+            offset = fh.tell()
+            for frame in ImgFormat.seq_frames(seq):
+                fh.write(frame)
+            nbytes = fh.tell() - offset
+        # the index entry is only written once the record is complete
+        with open(self.__file(scan_id, 'idx'), 'ab') as fh:
+            fh.write(self.index_entry.pack(offset, nbytes))
+        with self.__lock:
+            self.__nrecords[scan_id] = self.__nrecords.get(scan_id, 0) + 1
+        return self.__load(scan_id, offset, nbytes)
+
+    def release(self, seq):
+        # mark the oldest record of the scan of seq as fetched
+        scan_id = seq.scan_id
+        with self.__lock:
+            nreleased = self.__nreleased.get(scan_id, 0) + 1
+            self.__nreleased[scan_id] = nreleased
+            tmp = self.__file(scan_id, 'pos.tmp')
+            with open(tmp, 'wb') as fh:
+                fh.write(self.release_pos.pack(nreleased))
+            os.replace(tmp, self.__file(scan_id, 'pos'))
+            self.__cleanup()
+
+    def cleanup(self):
+        with self.__lock:
+            self.__cleanup()
+
+    def __cleanup(self):
+        # delete the files of the scans that are fully released and no longer appended to.
+        # Deleting a file with records that are still mapped (e.g. referenced by a message being sent)
+        # fails on Windows, those are retried next time.
+        for scan_id, nrecords in list(self.__nrecords.items()):
+            if scan_id == self.__last_scan or self.__nreleased.get(scan_id, 0) < nrecords:
+                continue
+            try:
+                os.remove(self.__file(scan_id, 'seg'))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                continue
+            for ext in ('idx', 'pos'):
+                try:
+                    os.remove(self.__file(scan_id, ext))
+                except OSError:
+                    pass
+            del self.__nrecords[scan_id]
+            self.__nreleased.pop(scan_id, None)
+
+    def load_pending(self):
+        # (re)read the index from disk and return all the records not released yet, oldest first
+        with self.__lock:
+            return self.__load_pending()
+
+    def __load_pending(self):
+        self.__nrecords = {}
+        self.__nreleased = {}
+        seqs = []
+        for scan_id in self.__scan_ids():
+            with open(self.__file(scan_id, 'idx'), 'rb') as fh:
+                index = fh.read()
+            # ignore an incomplete entry from a crash
+            nrecords = len(index) // self.index_entry.size
+            nreleased = 0
+            try:
+                with open(self.__file(scan_id, 'pos'), 'rb') as fh:
+                    nreleased, = self.release_pos.unpack(fh.read(self.release_pos.size))
+            except (OSError, struct.error):
+                pass
+            self.__nrecords[scan_id] = nrecords
+            self.__nreleased[scan_id] = nreleased
+            for i in range(nreleased, nrecords):
+                offset, nbytes = self.index_entry.unpack_from(index, i * self.index_entry.size)
+                seqs.append(self.__load(scan_id, offset, nbytes))
+        self.__last_scan = None
+        self.__cleanup()
+        return seqs
+
+class SeqCache(object):
+    # Bounded cache of the sequences received by AnalysisUser, indexed by scan_id and seq_id.
+    # Once more than max_bytes are cached, the oldest sequences of the least recently used scan
+    # are evicted. Looking up or grabbing a scan marks it as recently used.
+    # Not thread safe, the owner is expected to hold its own lock.
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes # None for no limit
+        self.__scans = {} # scan_id -> {seq_id: SeqImgs}, both in arrival order
+        self.__lru = {} # scan_id -> None, least recently used first
+        self.nbytes = 0
+        self.nseqs = 0
+        self.nevicted = 0
+
+    def __touch(self, scan_id: int):
+        self.__lru.pop(scan_id, None)
+        self.__lru[scan_id] = None
+
+    def __remove_scan(self, scan_id: int):
+        seqs = self.__scans.pop(scan_id)
+        del self.__lru[scan_id]
+        for seq in seqs.values():
+            self.nbytes -= seq.nbytes
+        self.nseqs -= len(seqs)
+        return list(seqs.values())
+
+    def __evict(self):
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and self.nseqs > 1:
+            scan_id = next(iter(self.__lru))
+            seqs = self.__scans[scan_id]
+            seq = seqs.pop(next(iter(seqs)))
+            self.nbytes -= seq.nbytes
+            self.nseqs -= 1
+            self.nevicted += 1
+            if not seqs:
+                del self.__scans[scan_id]
+                del self.__lru[scan_id]
+
+    def set_limit(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.__evict()
+
+    def add(self, seq):
+        seqs = self.__scans.get(seq.scan_id)
+        if seqs is None:
+            seqs = self.__scans[seq.scan_id] = {}
+        old = seqs.pop(seq.seq_id, None)
+        if old is not None:
+            # sent again, keep the latest copy
+            self.nbytes -= old.nbytes
+            self.nseqs -= 1
+        seqs[seq.seq_id] = seq
+        self.nbytes += seq.nbytes
+        self.nseqs += 1
+        self.__touch(seq.scan_id)
+        self.__evict()
+
+    def extend(self, seqs):
+        for seq in seqs:
+            self.add(seq)
+
+    def __len__(self):
+        return self.nseqs
+
+    def scan_ids(self):
+        return list(self.__scans)
+
+    def get_seq(self, scan_id: int, seq_id: int):
+        # returns None if the sequence isn't cached (anymore)
+        seqs = self.__scans.get(scan_id)
+        if seqs is None:
+            return None
+        self.__touch(scan_id)
+        return seqs.get(seq_id)
+
+    def get_scan(self, scan_id: int):
+        seqs = self.__scans.get(scan_id)
+        if seqs is None:
+            return []
+        self.__touch(scan_id)
+        return list(seqs.values())
+
+    def pop_scan(self, scan_id: int):
+        # remove and return the cached sequences of scan_id in arrival order
+        if scan_id not in self.__scans:
+            return []
+        return self.__remove_scan(scan_id)
+
+    def pop_oldest(self):
+        # remove and return the oldest sequence of the oldest scan, None if empty
+        if not self.__scans:
+            return None
+        scan_id = next(iter(self.__scans))
+        seqs = self.__scans[scan_id]
+        seq = seqs.pop(next(iter(seqs)))
+        self.nbytes -= seq.nbytes
+        self.nseqs -= 1
+        if not seqs:
+            del self.__scans[scan_id]
+            del self.__lru[scan_id]
+        return seq
+
+    def pop_all(self):
+        # remove and return everything, scan by scan in arrival order. The sequences are handed over, not copied.
+        res = []
+        for seqs in self.__scans.values():
+            res.extend(seqs.values())
+        self.__scans = {}
+        self.__lru = {}
+        self.nbytes = 0
+        self.nseqs = 0
+        return res
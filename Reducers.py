@@ -0,0 +1,287 @@
+import os
+import sys
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import ImgFormat
+
+# Per sequence reducers for AnalysisUser.add_reducer. A reducer is called in a worker process with the
+# ImgFormat.SeqImgs of one sequence and returns a small result, usually a numpy array.
+# Reducers are pickled to the workers, so they have to be module level functions or
+# instances of module level classes like the ones below.
+
+class RoiSum(object):
+    # total counts in each roi of every image of block, result[img, roi].
+    # rois are [x0, x1, y0, y1], 0-based with the end excluded.
+    def __init__(self, rois, block=0):
+        self.rois = [[int(v) for v in roi] for roi in rois]
+        self.block = int(block)
+
+    def sums(self, seq):
+        import numpy as np
+        imgs = seq.blocks[self.block].to_ndarray()
+        res = np.empty((imgs.shape[2], len(self.rois)))
+        for i, (x0, x1, y0, y1) in enumerate(self.rois):
+            res[:, i] = imgs[x0:x1, y0:y1, :].sum(axis=(0, 1))
+        return res
+
+    def __call__(self, seq):
+        return self.sums(seq)
+
+class Threshold(RoiSum):
+    # whether the counts in each roi are above threshold (a single one or one per roi), result[img, roi]
+    def __init__(self, rois, threshold, block=0):
+        RoiSum.__init__(self, rois, block)
+        self.threshold = threshold
+
+    def __call__(self, seq):
+        import numpy as np
+        return self.sums(seq) > np.asarray(self.threshold, dtype=np.float64)
+
+class SubtractBackground(object):
+    # runs reducer on the sequence with background subtracted from the images of block.
+    # background is either a single shape_x x shape_y image or one for every image.
+    def __init__(self, reducer, background, block=0):
+        self.reducer = reducer
+        self.background = background
+        self.block = int(block)
+
+    def __call__(self, seq):
+        import numpy as np
+        bg = np.asarray(self.background, dtype=np.float64)
+        if bg.ndim == 2:
+            bg = bg[:, :, np.newaxis]
+        imgs = seq.blocks[self.block].to_ndarray() - bg
+        blocks = list(seq.blocks)
+        blocks[self.block] = ImgFormat.ImgBlock.from_buffer(imgs.ravel(order='F'), imgs.shape)
+        return self.reducer(ImgFormat.SeqImgs(seq.scan_id, seq.seq_id, blocks))
+
+class ReducedSeq(object):
+    # results of all the reducers for one sequence
+    def __init__(self, scan_id: int, seq_id: int, results=None, error=None):
+        self.scan_id = scan_id
+        self.seq_id = seq_id
+        self.results = {} if results is None else results # name -> result
+        self.error = error # message if a reducer failed
+
+# reducers of the current worker process, set once when the process starts
+_reducers = []
+
+def _init_worker(reducers):
+    global _reducers
+    _reducers = reducers
+
+def _reduce(buf):
+    seq = ImgFormat.decode_seq(buf)
+    return {name: reducer(seq) for name, reducer in _reducers}
+
+def _python_executable():
+    # embedded (e.g. in MATLAB) sys.executable isn't an interpreter the workers can be started with
+    exe = sys.executable
+    if os.path.basename(exe).lower().startswith('python'):
+        return exe
+    for name in ('python.exe', os.path.join('bin', 'python3'), 'python3'):
+        path = os.path.join(sys.exec_prefix, name)
+        if os.path.isfile(path):
+            return path
+    return exe
+
+class ReducePipeline(object):
+    # Runs the registered reducers on every submitted sequence in a process pool.
+    # Results are collected in the order the sequences were submitted.
+    # Workers are spawned rather than forked since the parent has zmq threads running.
+    def __init__(self, nworkers=None):
+        self.nworkers = nworkers # None for one per core
+        self.reducers = [] # (name, reducer)
+        self.__pool = None
+        self.__pending = deque() # (seq, future), oldest first
+
+    def active(self) -> bool:
+        return bool(self.reducers)
+
+    def npending(self) -> int:
+        return len(self.__pending)
+
+    def __restart(self):
+        # the reducers are sent to the workers once when they start rather than with every sequence.
+        # Sequences already submitted still finish in the old pool.
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False)
+            self.__pool = None
+
+    def __get_pool(self):
+        if self.__pool is None:
+            ctx = multiprocessing.get_context('spawn')
+            ctx.set_executable(_python_executable())
+            self.__pool = ProcessPoolExecutor(self.nworkers, mp_context=ctx, initializer=_init_worker,
+                                              initargs=(list(self.reducers),))
+        return self.__pool
+
+    def set_workers(self, nworkers):
+        self.nworkers = nworkers
+        self.__restart()
+
+    def add(self, name: str, reducer):
+        # replaces the reducer with the same name
+        self.reducers = [(n, r) for n, r in self.reducers if n != name]
+        self.reducers.append((name, reducer))
+        self.__restart()
+
+    def remove(self, name: str):
+        self.reducers = [(n, r) for n, r in self.reducers if n != name]
+        self.__restart()
+
+    def clear(self):
+        self.reducers = []
+        self.__restart()
+
+    def submit(self, seq, on_done=None):
+        # on_done is called without arguments from another thread once the result is ready.
+        # Errors (e.g. a worker that died and broke the pool) are reported as the result of seq
+        # and the next sequence gets a new pool.
+        try:
+            buf = b''.join(ImgFormat.seq_frames(seq))
+            fut = self.__get_pool().submit(_reduce, buf)
+        except Exception as e:
+            self.__restart()
+            fut = Future()
+            fut.set_exception(e)
+        if on_done is not None:
+            fut.add_done_callback(lambda fut: on_done())
+        self.__pending.append((seq, fut))
+
+    def collect(self):
+        # finished results, stops at the first sequence that is still being reduced
+        res = []
+        while self.__pending and self.__pending[0][1].done():
+            seq, fut = self.__pending.popleft()
+            try:
+                res.append(ReducedSeq(seq.scan_id, seq.seq_id, fut.result()))
+            except Exception as e:
+                res.append(ReducedSeq(seq.scan_id, seq.seq_id, error=repr(e)))
+        return res
+
+    def shutdown(self):
+        self.__restart()
+        self.__pending = deque()
+
+class Welford(object):
+    # running mean and variance of arrays of a fixed shape, updated one sample at a time
+    def __init__(self):
+        self.n = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, x):
+        import numpy as np
+        x = np.asarray(x, dtype=np.float64)
+        self.n += 1
+        if self.mean is None:
+            self.mean = x.copy()
+            self.m2 = np.zeros_like(self.mean)
+            return
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def variance(self):
+        import numpy as np
+        if self.n < 2:
+            return None if self.m2 is None else np.full_like(self.m2, np.nan)
+        return self.m2 / (self.n - 1)
+
+class PointStats(object):
+    # statistics of the sequences of one scan point. Every block (e.g. every roi) has its own
+    # mean and variance images, everything starts over when the shapes of the blocks change.
+    def __init__(self):
+        self.reset()
+        self.nerrors = 0 # sequences the statistics couldn't be updated with
+
+    def reset(self, shapes=None):
+        self.shapes = shapes # shape of every block
+        self.n = 0
+        self.imgs = [Welford() for _ in shapes or ()] # pixels per block, (shape_x, shape_y, nimgs)
+        self.atoms = Welford() # loading probability, (nimgs, nrois)
+        self.nloaded = 0 # per survival pair and roi, (npairs, nrois)
+        self.nsurvived = 0
+
+    def add(self, seq, threshold=None, survival=()):
+        shapes = [block.shape for block in seq.blocks]
+        if shapes != self.shapes:
+            self.reset(shapes)
+        self.n += 1
+        for acc, block in zip(self.imgs, seq.blocks):
+            acc.add(block.to_ndarray())
+        if threshold is None:
+            return
+        atoms = threshold(seq)
+        self.atoms.add(atoms)
+        if survival:
+            loaded = atoms[[load for load, _ in survival], :]
+            survived = loaded & atoms[[surv for _, surv in survival], :]
+            self.nloaded = self.nloaded + loaded
+            self.nsurvived = self.nsurvived + survived
+
+    def survival(self):
+        import numpy as np
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.asarray(self.nsurvived, dtype=np.float64) / self.nloaded
+
+    def to_dict(self):
+        # copies, so they can be handed out while the accumulation goes on.
+        # mean and variance are lists with one image stack per block.
+        res = {'n': self.n,
+               'nerrors': self.nerrors,
+               'mean': [None if acc.mean is None else acc.mean.copy() for acc in self.imgs],
+               'variance': [acc.variance() for acc in self.imgs]}
+        if self.atoms.n:
+            res['loading'] = self.atoms.mean.copy()
+            res['survival'] = self.survival()
+        return res
+
+class ScanStats(object):
+    # PointStats of every scan point, keyed by (scan_id, parameter index).
+    # The parameter index of sequence seq_id (1-based) is params[(seq_id - 1) % len(params)]
+    # with the (stacked and scrambled) parameter list of the scan, or 1 if it is not known.
+    # Atoms are detected with threshold, a Threshold reducer, and survival is P(atom in image surv |
+    # atom in image load) for every (load, surv) pair of 0-based image indices.
+    def __init__(self, threshold=None, survival=()):
+        self.threshold = threshold
+        self.survival = [(int(load), int(surv)) for load, surv in survival]
+        self.params = {} # scan_id -> list of parameter indices
+        self.points = {} # (scan_id, param) -> PointStats
+
+    def set_params(self, scan_id: int, params):
+        self.params[scan_id] = [int(p) for p in params]
+
+    def param_index(self, scan_id: int, seq_id: int) -> int:
+        params = self.params.get(scan_id)
+        if not params:
+            return 1
+        return params[(seq_id - 1) % len(params)]
+
+    def add(self, seq):
+        # never raises, e.g. a threshold that doesn't fit the images only counts the sequence in nerrors
+        key = (seq.scan_id, self.param_index(seq.scan_id, seq.seq_id))
+        point = self.points.get(key)
+        if point is None:
+            point = self.points[key] = PointStats()
+        try:
+            point.add(seq, self.threshold, self.survival)
+        except Exception:
+            point.nerrors += 1
+
+    def get(self, scan_id: int, param: int):
+        point = self.points.get((scan_id, param))
+        return None if point is None else point.to_dict()
+
+    def point_indices(self, scan_id: int):
+        return sorted(param for sid, param in self.points if sid == scan_id)
+
+    def clear(self, scan_id=None):
+        if scan_id is None:
+            self.points = {}
+            self.params = {}
+            return
+        self.points = {key: point for key, point in self.points.items() if key[0] != scan_id}
+        self.params.pop(scan_id, None)
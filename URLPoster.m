@@ -45,6 +45,48 @@ classdef URLPoster < handle
             %% DOING THIS !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
             output = char(self.pyconn.reply());
         end
+
+        function handle = submit(self, data, files)
+            % post in the background, the reply is collected with
+            % wait_reply(handle) while the next sequence is being prepared.
+            handle = self.pyconn.submit(py.dict(pyargs(data{:})), ...
+                                        py.dict(pyargs(files{:})));
+        end
+
+        function res = poll_reply(self, handle)
+            res = logical(self.pyconn.poll_reply(handle));
+        end
+
+        function output = wait_reply(self, handle)
+            %% Every submitted post needs its reply collected, same as reply()
+            while 1
+                res = self.pyconn.wait_reply(handle);
+                if res ~= py.None
+                    output = char(res);
+                    return
+                end
+            end
+        end
+
+        function set_compression(self, threshold, level)
+            % gzip request bodies of at least threshold bytes, negative to
+            % disable. The server has to accept Content-Encoding: gzip.
+            if ~exist('level', 'var')
+                level = 6;
+            end
+            self.pyconn.set_compression(int64(threshold), int64(level));
+        end
+
+        function set_dedup(self, enable)
+            % send the files the server already has by their hash only,
+            % the server needs to support it (see URLPoster.set_dedup)
+            self.pyconn.set_dedup(logical(enable));
+        end
+
+        function set_max_inflight(self, n)
+            % more than one lets posts reach the server out of order
+            self.pyconn.set_max_inflight(int64(n));
+        end
     end
 
     properties(Constant, Access=private)
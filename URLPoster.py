@@ -11,20 +11,186 @@
 # You should have received a copy of the GNU Lesser General Public
 # License along with this library.
 
-import requests
 from http import client as http_client
 import base64
+import copy
+import itertools
+import os
+import uuid
+import hashlib
+import zlib
+import select
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
 
 try:
     import urlparse
 except ImportError:
     import urllib.parse as urlparse
 
-class URLPoster(object):
-    def get_req(self, data, files):
-        return requests.Request('POST', self.__url, data=data,
-                                files=files).prepare()
+class MultipartRequest(object):
+    # multipart/form-data POST request with a body that is streamed part by part. Field values
+    # and in memory file contents are sent as they are and file objects are read in blocks, so
+    # the whole body is never built in memory. The length is computed up front so the body doesn't
+    # need chunked encoding, and it can be iterated again to resend the request.
+    # data values are strings, bytes-like objects or anything with a str(), files values are the
+    # content (same types or a file object) or a (filename, content[, content type]) tuple.
+    #
+    # With known (a set of sha256 hex digests the server has stored) every file part is tagged with
+    # an X-Content-SHA256 header, and the parts the server already has are replaced by their digest
+    # with the content type ref_type. full() gives the same request with all the contents included.
+    block_size = 64 * 1024
+    ref_type = 'application/x-sha256-ref'
+
+    def __init__(self, data, files, known=None):
+        self.boundary = uuid.uuid4().hex
+        self.__known = known
+        # (name, content, file start position or None, filename, content type). The start positions
+        # of file objects are taken now, since sending the body (or full()) reads them to the end.
+        self.__fields = []
+        for name, value in (data or {}).items():
+            self.__fields.append((name,) + self.__content(value) + (None, None))
+        self.__files = []
+        for name, value in (files or {}).items():
+            content_type = None
+            if isinstance(value, (tuple, list)):
+                filename = value[0]
+                if len(value) > 2:
+                    content_type = value[2]
+                value = value[1]
+            else:
+                filename = getattr(value, 'name', None)
+                filename = os.path.basename(filename) if isinstance(filename, str) else name
+            self.__files.append((name,) + self.__content(value) + (filename, content_type))
+        self.__build(known)
+
+    def __build(self, known):
+        self.digests = [] # digests of the file contents sent
+        self.refs = [] # digests sent instead of the file contents
+        self.__parts = [] # (header, content, file start position or None)
+        for name, value, start, filename, content_type in self.__fields:
+            self.__add(name, value, start, filename, content_type)
+        for name, value, start, filename, content_type in self.__files:
+            self.__add(name, value, start, filename, content_type, known)
+        self.__end = ('--%s--\r\n' % self.boundary).encode()
+        self.length = len(self.__end)
+        for header, content, start in self.__parts:
+            self.length += len(header) + self.__size(content, start) + 2
+        self.body = self
+        self.headers = {'Content-Type': 'multipart/form-data; boundary=%s' % self.boundary,
+                        'Content-Length': str(self.length)}
+
+    def full(self):
+        req = copy.copy(self)
+        req.__build(None if self.__known is None else set())
+        return req
+
+    def __add(self, name, value, start, filename=None, content_type=None, known=None):
+        header = '--%s\r\nContent-Disposition: form-data; name="%s"' % (self.boundary, name)
+        if filename is not None:
+            header += '; filename="%s"' % filename
+        if known is not None:
+            digest = self.__digest(value, start)
+            if digest in known:
+                content_type = self.ref_type
+                self.refs.append(digest)
+                value, start = digest.encode(), None
+            else:
+                header += '\r\nX-Content-SHA256: %s' % digest
+                self.digests.append(digest)
+        if content_type is not None:
+            header += '\r\nContent-Type: %s' % content_type
+        header = (header + '\r\n\r\n').encode()
+        self.__parts.append((header, value, start))
+
+    @staticmethod
+    def __content(value):
+        # the content to send and, for file objects, the position to start reading from
+        start = None
+        if hasattr(value, 'read'):
+            start = value.tell()
+        elif isinstance(value, str):
+            value = value.encode()
+        else:
+            try:
+                value = memoryview(value)
+                value = value.cast('B') if value.c_contiguous else memoryview(value.tobytes())
+            except TypeError:
+                value = str(value).encode()
+        return value, start
+
+    def __digest(self, content, start):
+        if start is None:
+            return hashlib.sha256(content).hexdigest()
+        h = hashlib.sha256()
+        content.seek(start)
+        while True:
+            block = content.read(self.block_size)
+            if not block:
+                break
+            h.update(block)
+        content.seek(start)
+        return h.hexdigest()
+
+    @staticmethod
+    def __size(content, start):
+        if start is None:
+            return len(content)
+        try:
+            return os.fstat(content.fileno()).st_size - start
+        except (AttributeError, OSError):
+            end = content.seek(0, os.SEEK_END)
+            content.seek(start)
+            return end - start
+
+    def __iter__(self):
+        # small pieces are sent together, large ones on their own without being copied
+        buf = bytearray()
+        for header, content, start in self.__parts:
+            buf += header
+            if start is not None:
+                content.seek(start)
+                while True:
+                    block = content.read(self.block_size)
+                    if not block:
+                        break
+                    if buf:
+                        yield bytes(buf)
+                        buf = bytearray()
+                    yield block
+            elif len(content) < self.block_size:
+                buf += content
+            else:
+                yield bytes(buf)
+                buf = bytearray()
+                yield content
+            buf += b'\r\n'
+        buf += self.__end
+        yield bytes(buf)
+
+class GzipRequest(object):
+    # req with its body compressed with gzip. The streamed body is compressed as it is generated,
+    # only the (much smaller) compressed body is kept in memory.
+    def __init__(self, req, level=6):
+        self.__req = req
+        self.__level = level
+        self.refs = getattr(req, 'refs', [])
+        comp = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        chunks = [comp.compress(chunk) for chunk in req.body]
+        chunks.append(comp.flush())
+        self.body = b''.join(chunks)
+        self.headers = dict(req.headers)
+        self.headers['Content-Encoding'] = 'gzip'
+        self.headers['Content-Length'] = str(len(self.body))
 
+    def full(self):
+        return GzipRequest(self.__req.full(), self.__level)
+
+class KeepAliveConnection(object):
+    # HTTP(S) connection to url kept alive between posts so that each one costs a single round trip
+    # instead of a new TCP (and TLS) handshake. It is reopened when the server closes it.
+    # Only to be used by one thread at a time.
     def __init__(self, url):
         self.__url = url
         o = urlparse.urlparse(url)
@@ -33,18 +199,188 @@ class URLPoster(object):
             self.__conn_type = http_client.HTTPSConnection
         else:
             self.__conn_type = http_client.HTTPConnection
+        self.__conn = None
+        self.__reused = False # whether the current request went out on a previously used connection
 
-    def post_req(self, req):
+    def __connect(self):
+        if self.__conn is not None:
+            self.__conn.close()
         self.__conn = self.__conn_type(self.__netloc)
+        self.__reused = False
+
+    def __dropped(self) -> bool:
+        # an idle connection has nothing to read unless the server closed it
+        sock = self.__conn.sock
+        if sock is None:
+            return True
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True
+
+    def __send(self, req):
         self.__conn.request('POST', self.__url, body=req.body,
                             headers=req.headers)
 
+    def post_req(self, req):
+        if self.__conn is None or self.__dropped():
+            self.__connect()
+        else:
+            self.__reused = True
+        try:
+            self.__send(req)
+        except (http_client.HTTPException, OSError):
+            # the kept alive connection is no good anymore (closed by the server or a reply
+            # that was never read). The server can't have taken an incomplete request, so
+            # try again once on a new one.
+            if not self.__reused:
+                raise
+            self.__connect()
+            self.__send(req)
+
+    def response(self):
+        # status, headers and body of the response to the last request.
+        # The request isn't sent again if reading the response fails, the server may have taken it.
+        res = self.__conn.getresponse()
+        # the response has to be read completely before the connection can be used again
+        body = res.read()
+        encoding = (res.headers.get('Content-Encoding') or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            body = zlib.decompress(body)
+        return res.status, res.headers, body
+
+    def reply(self):
+        status, headers, body = self.response()
+        if status != 200:
+            # TODO use appropriate error
+            raise RuntimeError("HTTP error %d" % status)
+        return body.decode('utf-8', 'ignore')
+
+class URLPoster(object):
+    def get_req(self, data, files):
+        with self.__known_lock:
+            known = None if self.__known is None else set(self.__known)
+        req = MultipartRequest(data, files, known)
+        if self.compress_threshold is not None:
+            req.headers['Accept-Encoding'] = 'gzip'
+            if req.length >= self.compress_threshold:
+                req = GzipRequest(req, self.compress_level)
+        return req
+
+    def __init__(self, url):
+        self.__url = url
+        self.__conn = KeepAliveConnection(url)
+        # submit() posts in the background, each worker thread has its own connection.
+        # With more than one worker the posts can reach the server out of order.
+        self.max_inflight = 1
+        self.__pool = None
+        self.__local = threading.local()
+        self.__futures = {} # handle -> future of the reply
+        self.__handles = itertools.count(1)
+        # Upload dedup, off unless the server supports it (see set_dedup).
+        # Digests of the file contents the server has stored, None when disabled.
+        self.__known = None
+        self.__known_lock = threading.Lock()
+        self.max_known = 4096
+        self.__last_req = None
+        # request bodies of at least compress_threshold bytes are sent gzip compressed, None to disable
+        self.compress_threshold = None
+        self.compress_level = 6
+
+    def set_compression(self, threshold=1024, level=6):
+        # compress request bodies larger than threshold bytes (None or negative to disable)
+        # with Content-Encoding: gzip and ask for compressed replies. The server has to support it.
+        self.compress_threshold = None if threshold is None or threshold < 0 else int(threshold)
+        self.compress_level = int(level)
+
+    def set_dedup(self, enable):
+        # Send file parts the server already has as a reference to their sha256 digest
+        # (see MultipartRequest) instead of the content. The server lists the digests it has stored
+        # in the X-Content-Stored response header, and answers a request with references it doesn't
+        # know with 409 and X-Content-Unknown, after which the request is sent again in full.
+        with self.__known_lock:
+            self.__known = set() if enable else None
+
+    def __update_known(self, header, add):
+        if not header:
+            return
+        digests = [d.strip() for d in header.split(',') if d.strip()]
+        with self.__known_lock:
+            if self.__known is None:
+                return
+            if not add:
+                self.__known.difference_update(digests)
+                return
+            if len(self.__known) + len(digests) > self.max_known:
+                self.__known.clear()
+            self.__known.update(digests)
+
+    def __reply(self, conn, req):
+        status, headers, body = conn.response()
+        if status == 409 and getattr(req, 'refs', None):
+            # the server lost some of the contents, forget them and send everything
+            self.__update_known(headers.get('X-Content-Unknown') or ','.join(req.refs), False)
+            conn.post_req(req.full())
+            status, headers, body = conn.response()
+        if status != 200:
+            # TODO use appropriate error
+            raise RuntimeError("HTTP error %d" % status)
+        self.__update_known(headers.get('X-Content-Stored'), True)
+        return body.decode('utf-8', 'ignore')
+
+    def post_req(self, req):
+        self.__last_req = req
+        self.__conn.post_req(req)
+
     def post(self, data, files):
         self.post_req(self.get_req(data, files))
 
     def reply(self):
-        res = self.__conn.getresponse()
-        if res.status != 200:
-            # TODO use appropriate error
-            raise RuntimeError("HTTP error %d" % res.status)
-        return res.read().decode('utf-8', 'ignore')
+        return self.__reply(self.__conn, self.__last_req)
+
+    def __post_async(self, data, files):
+        conn = getattr(self.__local, 'conn', None)
+        if conn is None:
+            conn = self.__local.conn = KeepAliveConnection(self.__url)
+        req = self.get_req(data, files)
+        conn.post_req(req)
+        return self.__reply(conn, req)
+
+    def set_max_inflight(self, n):
+        # number of background posts sent at the same time
+        self.max_inflight = max(int(n), 1)
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=False)
+            self.__pool = None
+
+    def submit(self, data, files):
+        # post in the background and return a handle for the reply right away,
+        # so that the next sequence can be prepared while this one is sent and processed.
+        if self.__pool is None:
+            self.__pool = ThreadPoolExecutor(self.max_inflight)
+        handle = next(self.__handles)
+        self.__futures[handle] = self.__pool.submit(self.__post_async, data, files)
+        return handle
+
+    def poll_reply(self, handle) -> bool:
+        # whether the reply to handle has arrived
+        return self.__futures[handle].done()
+
+    def wait_reply(self, handle, timeout=1):
+        # the reply to handle, None if it didn't arrive within timeout seconds.
+        # Errors of the post are raised here. The handle can't be used anymore once this returns a reply.
+        fut = self.__futures[handle]
+        try:
+            res = fut.result(timeout)
+        except FutureTimeout:
+            return None
+        finally:
+            if fut.done():
+                del self.__futures[handle]
+        return res
+
+    def npending(self) -> int:
+        # number of submitted posts whose reply wasn't collected yet
+        return len(self.__futures)
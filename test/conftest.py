@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the python modules live next to their MATLAB wrappers in the top level directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,97 @@
+import array
+import socket
+import time
+import pytest
+zmq = pytest.importorskip('zmq')
+import AnalysisServer
+import ExptClient
+
+def free_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'tcp://127.0.0.1:%d' % sock.getsockname()[1]
+
+def test_credits():
+    credits = AnalysisServer.Credits(2)
+    assert credits.hello(b'a') == 2
+    # ran out of credit, but the two messages are still on their way
+    assert credits.hello(b'a') == 0
+    assert credits.take() == 1
+    assert credits.hello(b'a') == 0
+    # new socket, the credit granted to the old one is gone
+    assert credits.hello(b'b') == 2
+
+def test_stream_credit():
+    url = free_url()
+    server = AnalysisServer.AnalysisStreamServer(url, window=2)
+    client = ExptClient.ExptStreamClient(url)
+    client.timeout = 0.2
+    try:
+        # initial window for the hello
+        assert server.recv_info() is None
+        assert client.send_config('date', 'time')
+        assert client.send_end_seq(1)
+        # out of credit until the server takes a message
+        assert not client.send_end_seq(2)
+        assert server.recv_info() == 'config'
+        assert server.recv_config() == ['date', 'time']
+        assert server.recv_info() == 'end_seq'
+        assert server.recv_end_seq() == 1
+        # the hello sent when the client ran out isn't counted on top of the credit handed back
+        assert server.recv_info() is None
+        assert client.send_end_seq(3)
+        assert client.send_end_seq(4)
+        assert not client.send_end_seq(5)
+        assert [server.recv_info() for _ in range(2)] == ['end_seq', 'end_seq']
+        assert server.recv_end_seq() == 4
+    finally:
+        server.close()
+
+def test_stream_reconnect():
+    url = free_url()
+    server = AnalysisServer.AnalysisStreamServer(url, window=2)
+    client = ExptClient.ExptStreamClient(url)
+    client.timeout = 0.5
+    try:
+        # the server grants the initial window, which the client never reads
+        assert server.recv_info() is None
+        client.recreate_sock()
+        assert server.recv_info() is None
+        assert client.send_end_seq(1)
+        assert client.send_end_seq(2)
+        assert server.recv_info() == 'end_seq'
+        assert server.recv_end_seq() == 1
+    finally:
+        server.close()
+
+def test_router():
+    url = free_url()
+    server = AnalysisServer.AnalysisRouterServer(url, window=2)
+    stream = ExptClient.ExptStreamClient(url)
+    req = ExptClient.ExptClient(url)
+    try:
+        assert stream.send_config('date', 'time')
+        req.send_imgs(array.array('d', range(6)), array.array('d', [3, 2, 1]))
+        msgs = [server.recv_msg(timeout=5) for _ in range(2)]
+        assert sorted(msg[1] for msg in msgs) == ['config', 'images']
+        clients = {msg[1]: msg[0] for msg in msgs}
+        assert sorted(server.get_clients()) == sorted(clients.values())
+        imgs = [msg[2] for msg in msgs if msg[1] == 'images'][0]
+        assert list(imgs[0]) == [3, 2, 1]
+        assert list(imgs[1]) == list(range(6))
+        # the REQ client gets go/stop with its reply
+        server.send_stop(clients['images'])
+        assert req.recv_reply() == 1
+        req.send_end_seq(7)
+        assert server.recv_msg(clients['images'], timeout=5) == [clients['images'], 'end_seq', 7]
+        assert req.recv_reply() == 0
+        # the streaming client is told in-band
+        server.send_stop(clients['config'])
+        for _ in range(250):
+            if stream.check_stop():
+                break
+            time.sleep(0.02)
+        assert stream.check_stop()
+        assert server.get_session(clients['images'])['nimgs'] == 1
+    finally:
+        server.close()
@@ -0,0 +1,59 @@
+import array
+import socket
+import time
+import pytest
+zmq = pytest.importorskip('zmq')
+import ExptServer
+from AnalysisUser import AnalysisUser
+
+def free_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'tcp://127.0.0.1:%d' % sock.getsockname()[1]
+
+def store_seq(server, scan_id, seq_id, npixels=12):
+    server.store_typed_imgs(array.array('H', [(seq_id + j) % 1000 for j in range(npixels)]),
+                            (npixels, 1, 1), scan_id, seq_id)
+    server.seq_finish()
+
+def wait_for(cond, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+@pytest.fixture
+def server():
+    url = free_url()
+    srv = ExptServer.ExptServer(url)
+    srv.url = url
+    yield srv
+    srv.stop_worker()
+
+@pytest.fixture
+def user(server):
+    au = AnalysisUser(server.url)
+    au.set_refresh_rate(0.05)
+    yield au
+    au.stop_worker()
+
+def test_cursor_reset(server, user):
+    server.set_log_retention(max_seqs=10, keep_queue=False)
+    for i in range(2):
+        store_seq(server, 1, i)
+    # cursor left over from before the server restarted
+    user.use_cursor(100)
+    wait_for(lambda: len(user.get_scan_ids()) > 0 and user.cursor == 2)
+    assert [seq.seq_id for seq in user.grab_imgs()] == [0, 1]
+    assert user.get_num_missed() == 0
+    store_seq(server, 1, 2)
+    wait_for(lambda: user.cursor == 3)
+    assert [seq.seq_id for seq in user.grab_imgs()] == [2]
+
+def test_msg(server, user):
+    # replies to requests and status changes are all one element lists
+    wait_for(lambda: user.check_msg() == ['Sequence is stopped'])
+    user.pause_seq()
+    wait_for(lambda: user.check_msg() == ['Sequence is not running'])
+    user.set_roi(rois=[[0, 2, 0, 1]])
+    wait_for(lambda: user.check_msg() == ['ok'])
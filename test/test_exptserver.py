@@ -0,0 +1,87 @@
+import array
+import json
+import socket
+import pytest
+zmq = pytest.importorskip('zmq')
+import ImgFormat
+import ExptServer
+from AnalysisClient import AnalysisClient
+
+def free_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'tcp://127.0.0.1:%d' % sock.getsockname()[1]
+
+def store_seq(server, scan_id, seq_id, npixels=12):
+    server.store_typed_imgs(array.array('H', [(seq_id + j) % 1000 for j in range(npixels)]),
+                            (npixels, 1, 1), scan_id, seq_id)
+    server.seq_finish()
+
+@pytest.fixture
+def server():
+    url = free_url()
+    srv = ExptServer.ExptServer(url)
+    srv.url = url
+    yield srv
+    srv.stop_worker()
+
+@pytest.fixture
+def client(server):
+    ac = AnalysisClient(server.url)
+    yield ac
+    ac.close()
+
+def test_status_dropped(server, client):
+    server.set_queue_limits(max_seqs=1, policy=ExptServer.ExptServer.OverflowPolicy.DropNewest.value)
+    for i in range(3):
+        store_seq(server, 1, i)
+    assert client.get_status_dropped(5000) == ['Sequence is stopped', '2 sequences dropped']
+    # both frames were read, the next request still works
+    assert client.get_status(5000) == ['Sequence is stopped']
+    assert client.get_num_imgs_dropped(5000) == [1, 2]
+
+def test_compress_stats(server, client):
+    store_seq(server, 1, 1, 5000)
+    client.set_compression('zlib')
+    assert len(client.get_typed_imgs(5000)) == 1
+    # decompression on the client side and compression on the server side
+    stats = client.get_compress_stats()
+    server_stats = json.loads(client.get_server_compress_stats(5000)[0])
+    assert stats['raw_bytes'] == server_stats['raw_bytes'] == 10000
+    assert stats['compressed_bytes'] == server_stats['compressed_bytes'] < 10000
+
+def test_imgs_since(server, client):
+    server.set_log_retention(max_seqs=3, keep_queue=False)
+    for i in range(5):
+        store_seq(server, 1, i)
+    # the two oldest dropped out of the log
+    nxt, first, more, seqs, reset = client.get_imgs_since(5000, index=0, max_seqs=2)
+    assert (nxt, first, more, reset) == (4, 2, True, False)
+    assert [seq.seq_id for seq in seqs] == [2, 3]
+    nxt, first, more, seqs, reset = client.get_imgs_since(5000, index=nxt)
+    assert (nxt, more, reset) == (5, False, False)
+    assert [seq.seq_id for seq in seqs] == [4]
+    # reading doesn't take them away from other clients
+    assert [seq.seq_id for seq in client.get_imgs_since(5000, index=0)[3]] == [2, 3, 4]
+    assert client.get_imgs_since(5000, index=5)[:3] == [5, 2, False]
+
+def test_imgs_since_reset(server, client):
+    server.set_log_retention(max_seqs=10, keep_queue=False)
+    for i in range(2):
+        store_seq(server, 1, i)
+    # cursor of a previous server session
+    nxt, first, more, seqs, reset = client.get_imgs_since(5000, index=100)
+    assert (nxt, first, more, reset) == (2, 0, False, True)
+    assert [seq.seq_id for seq in seqs] == [0, 1]
+
+def test_roi_binning(server, client):
+    server.store_typed_imgs(array.array('B', [255] * 64), (8, 8, 1), 1, 1)
+    server.seq_finish()
+    assert client.set_roi(5000, rois=[[0, 4, 0, 4], [4, 8, 0, 8]], binning=2) == ['ok']
+    seqs = client.get_imgs_multipart(5000)
+    # binned uint8 pixels fit in uint16
+    assert [(block.shape, block.dtype_name) for block in seqs[0].blocks] == [((2, 2, 1), 'uint16'),
+                                                                           ((2, 4, 1), 'uint16')]
+    assert memoryview(seqs[0].blocks[0].data).tolist() == [1020] * 4
+    stats = client.get_stats(5000)
+    assert stats['bytes_sent'] < 200
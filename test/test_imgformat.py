@@ -0,0 +1,113 @@
+import array
+import pytest
+import ImgFormat
+
+def make_seq(scan_id, seq_id, typecode='H', shapes=((4, 3, 2),)):
+    blocks = []
+    for i, (sx, sy, nimgs) in enumerate(shapes):
+        n = sx * sy * nimgs
+        blocks.append(ImgFormat.ImgBlock.from_buffer(array.array(typecode, [(j * 7 + i) % 100 for j in range(n)]),
+                                                    (sx, sy, nimgs)))
+    return ImgFormat.SeqImgs(scan_id, seq_id, blocks)
+
+def pixels(block):
+    return memoryview(block.data).tolist()
+
+def assert_same(seqs, res):
+    assert len(res) == len(seqs)
+    for seq, dec in zip(seqs, res):
+        assert (dec.scan_id, dec.seq_id) == (seq.scan_id, seq.seq_id)
+        assert len(dec.blocks) == len(seq.blocks)
+        for block, dblock in zip(seq.blocks, dec.blocks):
+            assert dblock.dtype == block.dtype
+            assert dblock.shape == block.shape
+            assert pixels(dblock) == pixels(block)
+
+@pytest.mark.parametrize('typecode', ['d', 'f', 'B', 'b', 'H', 'h', 'I', 'i', 'q', 'Q'])
+def test_typed_round_trip(typecode):
+    seqs = [make_seq(1700000000000, 1, typecode, ((4, 3, 2), (2, 2, 1))), make_seq(1700000000000, 2, typecode)]
+    assert_same(seqs, ImgFormat.decode(ImgFormat.encode(seqs)))
+    # same thing with every chunk in its own frame
+    assert_same(seqs, ImgFormat.decode(ImgFormat.encode_frames(seqs)))
+
+def test_typed_flags_and_empty_seq():
+    seqs = [ImgFormat.SeqImgs(5, 1), make_seq(5, 2)]
+    flags, res = ImgFormat.decode_stream(ImgFormat.encode(seqs, flags=ImgFormat.FLAG_MORE))
+    assert flags & ImgFormat.FLAG_MORE
+    assert_same(seqs, res)
+    assert ImgFormat.decode(ImgFormat.encode([])) == []
+
+def test_seq_record_round_trip():
+    seq = make_seq(3, 4, 'h', ((5, 5, 3),))
+    assert_same([seq], [ImgFormat.decode_seq(b''.join(ImgFormat.seq_frames(seq)))])
+
+def test_decode_errors():
+    buf = ImgFormat.encode([make_seq(1, 1)])
+    with pytest.raises(ValueError):
+        ImgFormat.decode(buf[:-1])
+    with pytest.raises(ValueError):
+        ImgFormat.decode(b'XXXX' + buf[4:])
+
+def test_legacy_round_trip():
+    seqs = [make_seq(10, 1, 'd', ((4, 3, 2), (2, 2, 1))), ImgFormat.SeqImgs(10, 2), make_seq(10, 3, 'H')]
+    res = ImgFormat.decode_legacy(ImgFormat.encode_legacy(seqs))
+    # empty sequences are skipped and everything comes back as double
+    assert [(seq.scan_id, seq.seq_id) for seq in res] == [(10, 1), (10, 3)]
+    for seq, dec in zip([seqs[0], seqs[2]], res):
+        for block, dblock in zip(seq.blocks, dec.blocks):
+            assert dblock.dtype == 1
+            assert dblock.shape == block.shape
+            assert pixels(dblock) == [float(v) for v in pixels(block)]
+    assert ImgFormat.decode_legacy(ImgFormat.encode_legacy([])) == []
+
+def test_legacy_block():
+    block = ImgFormat.ImgBlock.from_legacy(array.array('d', [2, 1, 1, 3.5, 4.5]))
+    assert block.shape == (2, 1, 1)
+    assert pixels(block) == [3.5, 4.5]
+
+def test_from_buffer():
+    block = ImgFormat.ImgBlock.from_buffer(bytes(range(6)), (3, 2), dtype='uint8')
+    assert block.shape == (3, 2, 1)
+    assert block.dtype_name == 'uint8'
+    with pytest.raises(ValueError):
+        ImgFormat.ImgBlock.from_buffer(array.array('H', range(5)), (3, 2))
+    with pytest.raises(ValueError):
+        ImgFormat.dtype_from_name('logical')
+
+@pytest.mark.parametrize('method', ['zlib', 'lzma'])
+@pytest.mark.parametrize('typecode', ['d', 'B', 'H', 'i'])
+def test_compressed_round_trip(method, typecode):
+    seqs = [make_seq(1, 1, typecode, ((16, 16, 4), (3, 2, 1)))]
+    stats = ImgFormat.CompressStats()
+    buf = ImgFormat.encode(seqs, compress=method, level=1, stats=stats)
+    assert len(buf) < len(ImgFormat.encode(seqs))
+    assert stats.compressed_bytes > 0 and stats.ratio > 1
+    dstats = ImgFormat.CompressStats()
+    assert_same(seqs, ImgFormat.decode(buf, dstats))
+    assert dstats.raw_bytes == stats.raw_bytes
+
+def test_compression_needs_version_2():
+    seqs = [make_seq(1, 1)]
+    assert ImgFormat.encode(seqs, version=1, compress='zlib') == ImgFormat.encode(seqs, version=1)
+
+def test_shuffle():
+    data = array.array('I', range(1000))
+    shuffled = ImgFormat.shuffle(data, 4)
+    assert bytes(ImgFormat.unshuffle(shuffled, 4)) == data.tobytes()
+
+def test_to_array():
+    block = make_seq(1, 1, 'h').blocks[0]
+    res = ImgFormat.to_array(block.data)
+    assert res.typecode == 'h'
+    assert res.tolist() == pixels(block)
+
+@pytest.mark.parametrize('typecode,binning,dtype', [('B', 2, 'uint16'), ('H', 2, 'uint32'), ('H', 300, 'uint64'),
+                                                    ('b', 4, 'int16'), ('i', 2, 'int64'), ('d', 2, 'double')])
+def test_binning_dtype(typecode, binning, dtype):
+    np = pytest.importorskip('numpy')
+    seq = make_seq(1, 1, typecode, ((2 * binning, binning, 1),))
+    res = ImgFormat.ImgView(binning=binning).apply(seq).blocks[0]
+    assert res.dtype_name == dtype
+    assert res.shape == (2, 1, 1)
+    expected = seq.blocks[0].to_ndarray().astype(np.float64).reshape((binning, 2, binning, 1), order='F').sum(axis=(0, 2))
+    assert pixels(res) == expected.ravel(order='F').tolist()
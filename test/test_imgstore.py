@@ -0,0 +1,99 @@
+import array
+import gc
+import os
+import ImgFormat
+import ImgStore
+
+def make_seq(scan_id, seq_id, npixels=100):
+    data = array.array('H', [(seq_id + j) % 1000 for j in range(npixels)])
+    return ImgFormat.SeqImgs(scan_id, seq_id, [ImgFormat.ImgBlock.from_buffer(data, (npixels, 1, 1))])
+
+def pixels(seq):
+    return memoryview(seq.blocks[0].data).tolist()
+
+def test_spill_append_and_load(tmp_path):
+    store = ImgStore.SpillStore(str(tmp_path))
+    seqs = [make_seq(1, i, 5000) for i in range(20)]
+    spilled = [store.append(seq) for seq in seqs]
+    for seq, res in zip(seqs, spilled):
+        assert res.spilled
+        assert (res.scan_id, res.seq_id) == (seq.scan_id, seq.seq_id)
+        assert pixels(res) == pixels(seq)
+
+def test_spill_restart(tmp_path):
+    store = ImgStore.SpillStore(str(tmp_path))
+    seqs = [make_seq(1, i) for i in range(5)] + [make_seq(2, i) for i in range(3)]
+    spilled = [store.append(seq) for seq in seqs]
+    for seq in spilled[:2]:
+        store.release(seq)
+    # a new store on the same directory, e.g. after a crash
+    pending = ImgStore.SpillStore(str(tmp_path)).load_pending()
+    assert [(seq.scan_id, seq.seq_id) for seq in pending] == [(seq.scan_id, seq.seq_id) for seq in seqs[2:]]
+    for seq, res in zip(seqs[2:], pending):
+        assert pixels(res) == pixels(seq)
+
+def test_spill_incomplete_index(tmp_path):
+    store = ImgStore.SpillStore(str(tmp_path))
+    for i in range(3):
+        store.append(make_seq(1, i))
+    # half written index entry of a record that never finished
+    with open(os.path.join(str(tmp_path), 'scan_1.idx'), 'ab') as fh:
+        fh.write(b'\0' * 5)
+    assert [seq.seq_id for seq in ImgStore.SpillStore(str(tmp_path)).load_pending()] == [0, 1, 2]
+
+def test_spill_cleanup(tmp_path):
+    store = ImgStore.SpillStore(str(tmp_path))
+    spilled = [store.append(make_seq(1, i)) for i in range(3)]
+    for seq in spilled:
+        store.release(seq)
+    # still the scan being appended to
+    assert os.path.exists(os.path.join(str(tmp_path), 'scan_1.seg'))
+    store.append(make_seq(2, 0))
+    # the mappings of the released records have to be gone before the files can be deleted on Windows
+    del spilled, seq
+    gc.collect()
+    store.cleanup()
+    assert not os.path.exists(os.path.join(str(tmp_path), 'scan_1.seg'))
+    assert [seq.scan_id for seq in ImgStore.SpillStore(str(tmp_path)).load_pending()] == [2]
+
+def test_cache_lookup():
+    cache = ImgStore.SeqCache()
+    cache.extend([make_seq(1, 1), make_seq(1, 2), make_seq(2, 1)])
+    assert len(cache) == 3
+    assert cache.scan_ids() == [1, 2]
+    assert cache.get_seq(1, 2).seq_id == 2
+    assert cache.get_seq(3, 1) is None
+    # a sequence sent again replaces the old copy
+    cache.add(make_seq(1, 1))
+    assert len(cache) == 3
+    assert [seq.seq_id for seq in cache.pop_scan(1)] == [2, 1]
+    assert cache.pop_oldest().scan_id == 2
+    assert cache.pop_oldest() is None
+    assert cache.nbytes == 0
+
+def test_cache_eviction():
+    seq_bytes = make_seq(1, 1).nbytes
+    cache = ImgStore.SeqCache(4 * seq_bytes)
+    cache.extend([make_seq(1, i) for i in range(3)])
+    cache.extend([make_seq(2, i) for i in range(1)])
+    # scan 1 was used last, so scan 2 is evicted first
+    cache.get_scan(1)
+    cache.add(make_seq(3, 0))
+    assert cache.nevicted == 1
+    assert cache.scan_ids() == [1, 3]
+    # then the oldest sequences of the least recently used scan
+    cache.add(make_seq(3, 1))
+    assert cache.get_seq(1, 0) is None
+    assert cache.nbytes <= cache.max_bytes
+    assert cache.nevicted == 2
+    # the lookup above made scan 1 the most recently used one
+    cache.set_limit(seq_bytes)
+    assert len(cache) == 1
+    assert [(seq.scan_id, seq.seq_id) for seq in cache.pop_all()] == [(1, 2)]
+
+def test_cache_keeps_one_seq():
+    # a single sequence larger than the limit is still kept
+    cache = ImgStore.SeqCache(10)
+    cache.add(make_seq(1, 1))
+    assert len(cache) == 1
+    assert cache.nevicted == 0
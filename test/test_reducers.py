@@ -0,0 +1,67 @@
+import array
+import os
+import time
+import pytest
+import ImgFormat
+import Reducers
+
+def make_seq(scan_id, seq_id, shape=(4, 3, 2)):
+    n = shape[0] * shape[1] * shape[2]
+    data = array.array('H', [(seq_id + j) % 1000 for j in range(n)])
+    return ImgFormat.SeqImgs(scan_id, seq_id, [ImgFormat.ImgBlock.from_buffer(data, shape)])
+
+class Crash(object):
+    # kills the worker process on sequence 1, which breaks the pool
+    def __call__(self, seq):
+        if seq.seq_id == 1:
+            os._exit(1)
+        return seq.seq_id
+
+def collect(pipe, n, timeout=60):
+    res = []
+    deadline = time.monotonic() + timeout
+    while len(res) < n:
+        assert time.monotonic() < deadline
+        res.extend(pipe.collect())
+        time.sleep(0.02)
+    return res
+
+def test_broken_pool():
+    pipe = Reducers.ReducePipeline(1)
+    pipe.add('crash', Crash())
+    try:
+        pipe.submit(make_seq(1, 1))
+        res = collect(pipe, 1)
+        assert 'BrokenProcessPool' in res[0].error
+        # submitting to the broken pool is reported as an error too, then a new pool is started
+        pipe.submit(make_seq(1, 2))
+        pipe.submit(make_seq(1, 3))
+        res = collect(pipe, 2)
+        assert [(r.seq_id, r.error is None) for r in res] == [(2, False), (3, True)]
+        assert res[1].results == {'crash': 3}
+    finally:
+        pipe.shutdown()
+
+def test_point_stats_per_block():
+    np = pytest.importorskip('numpy')
+    stats = Reducers.ScanStats()
+    # blocks of different sizes, e.g. rois
+    for i in range(3):
+        stats.add(ImgFormat.SeqImgs(1, i + 1, [make_seq(1, i).blocks[0], make_seq(1, 2 * i, (2, 2, 1)).blocks[0]]))
+    res = stats.get(1, 1)
+    assert res['n'] == 3
+    assert [mean.shape for mean in res['mean']] == [(4, 3, 2), (2, 2, 1)]
+    np.testing.assert_allclose(res['mean'][1], make_seq(1, 2, (2, 2, 1)).blocks[0].to_ndarray())
+    np.testing.assert_allclose(res['variance'][0], np.ones((4, 3, 2)))
+    # the frame size changed, the statistics start over
+    stats.add(make_seq(1, 4, (5, 5, 1)))
+    res = stats.get(1, 1)
+    assert res['n'] == 1
+    assert [mean.shape for mean in res['mean']] == [(5, 5, 1)]
+
+def test_point_stats_errors():
+    pytest.importorskip('numpy')
+    # the threshold looks at a block the sequences don't have
+    stats = Reducers.ScanStats(Reducers.Threshold([[0, 1, 0, 1]], 10, block=1))
+    stats.add(make_seq(1, 1))
+    assert stats.get(1, 1)['nerrors'] == 1
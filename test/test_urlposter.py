@@ -0,0 +1,234 @@
+import gzip
+import hashlib
+import http.client
+import io
+import threading
+import time
+import email.parser
+import email.policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import URLPoster
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        srv = self.server
+        raw = self.rfile.read(int(self.headers['Content-Length']))
+        body = raw
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(raw)
+        msg = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        parts = {}
+        unknown = []
+        stored = []
+        for part in msg.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            content = part.get_payload(decode=True)
+            if part.get_content_type() == URLPoster.MultipartRequest.ref_type:
+                digest = content.decode()
+                if digest not in srv.store:
+                    unknown.append(digest)
+                    continue
+                content = srv.store[digest]
+            elif part['X-Content-SHA256']:
+                srv.store[part['X-Content-SHA256']] = content
+                stored.append(part['X-Content-SHA256'])
+            parts[name] = content
+        with srv.lock:
+            srv.requests.append({'headers': self.headers, 'raw': raw, 'parts': parts, 'msg': msg,
+                                 'port': self.client_address[1]})
+            n = len(srv.requests)
+        if srv.no_reply:
+            # crashed after it got the request
+            self.close_connection = True
+            return
+        if unknown:
+            self.reply(409, b'unknown', {'X-Content-Unknown': ','.join(unknown)})
+            return
+        headers = {}
+        if stored:
+            headers['X-Content-Stored'] = ','.join(stored)
+        self.reply(200, ('reply %d' % n).encode(), headers)
+
+    def reply(self, status, body, headers):
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.close_connections:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        if self.server.drop_idle:
+            # closed after the reply without telling the client, like an idle timeout
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    srv.daemon_threads = True
+    srv.requests = []
+    srv.store = {} # digest -> content
+    srv.lock = threading.Lock()
+    srv.close_connections = False
+    srv.drop_idle = False
+    srv.no_reply = False
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    srv.url = 'http://127.0.0.1:%d/' % srv.server_address[1]
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+def test_keep_alive(server):
+    poster = URLPoster.URLPoster(server.url)
+    for i in range(3):
+        poster.post({'seq': str(i)}, {'file': ('seq.txt', b'content %d' % i)})
+        assert poster.reply() == 'reply %d' % (i + 1)
+    assert [req['parts']['seq'] for req in server.requests] == [b'0', b'1', b'2']
+    # all on the same connection
+    assert len({req['port'] for req in server.requests}) == 1
+
+def test_reconnect(server):
+    server.close_connections = True
+    poster = URLPoster.URLPoster(server.url)
+    for i in range(3):
+        poster.post({'seq': str(i)}, {})
+        assert poster.reply() == 'reply %d' % (i + 1)
+    assert len({req['port'] for req in server.requests}) == 3
+
+def test_idle_close(server):
+    server.drop_idle = True
+    poster = URLPoster.URLPoster(server.url)
+    for i in range(3):
+        poster.post({'seq': str(i)}, {})
+        assert poster.reply() == 'reply %d' % (i + 1)
+        # give the server time to close the connection
+        time.sleep(0.1)
+    assert len(server.requests) == 3
+
+def test_no_resend_after_request(server):
+    poster = URLPoster.URLPoster(server.url)
+    poster.post({'seq': '0'}, {})
+    assert poster.reply() == 'reply 1'
+    # the connection is reused and the server got the request, it mustn't be sent twice
+    server.no_reply = True
+    poster.post({'seq': '1'}, {})
+    with pytest.raises((http.client.HTTPException, OSError)):
+        poster.reply()
+    assert len(server.requests) == 2
+    server.no_reply = False
+    poster.post({'seq': '2'}, {})
+    assert poster.reply() == 'reply 3'
+
+def test_submit(server):
+    poster = URLPoster.URLPoster(server.url)
+    handles = [poster.submit({'seq': str(i)}, {}) for i in range(4)]
+    assert poster.npending() == 4
+    replies = [poster.wait_reply(handle, timeout=10) for handle in handles]
+    assert sorted(replies) == ['reply %d' % i for i in range(1, 5)]
+    assert poster.npending() == 0
+    assert [req['parts']['seq'] for req in server.requests] == [b'0', b'1', b'2', b'3']
+
+def test_multipart_content_length(server, tmp_path):
+    path = tmp_path / 'big.bin'
+    big = bytes(range(256)) * 1000 # several blocks
+    path.write_bytes(big)
+    with open(str(path), 'rb') as fh:
+        req = URLPoster.MultipartRequest({'name': 'seq', 'num': 3, 'raw': b'\x00\x01'},
+                                         {'file': fh, 'text': ('a.json', '{}', 'application/json'),
+                                          'mem': memoryview(big)})
+        body = b''.join(req.body)
+        assert len(body) == req.length == int(req.headers['Content-Length'])
+        # the body can be sent again
+        assert b''.join(req.body) == body
+        poster = URLPoster.URLPoster(server.url)
+        poster.post_req(req)
+        assert poster.reply() == 'reply 1'
+    parts = server.requests[0]['parts']
+    assert parts == {'name': b'seq', 'num': b'3', 'raw': b'\x00\x01', 'file': big, 'text': b'{}', 'mem': big}
+    files = {part.get_param('name', header='content-disposition'): part
+             for part in server.requests[0]['msg'].iter_parts()}
+    assert files['file'].get_filename() == 'big.bin'
+    assert files['text'].get_filename() == 'a.json'
+    assert files['text'].get_content_type() == 'application/json'
+
+def test_dedup(server):
+    poster = URLPoster.URLPoster(server.url)
+    poster.set_dedup(True)
+    content = b'x' * 10000
+    poster.post({}, {'file': ('a.txt', content)})
+    poster.reply()
+    assert server.store == {hashlib.sha256(content).hexdigest(): content}
+    # sent as a reference the second time
+    poster.post({'seq': '2'}, {'file': ('a.txt', content)})
+    assert poster.reply() == 'reply 2'
+    assert len(server.requests[1]['raw']) < len(content)
+    assert server.requests[1]['parts']['file'] == content
+
+def test_dedup_fallback(server):
+    poster = URLPoster.URLPoster(server.url)
+    poster.set_dedup(True)
+    content = b'y' * 10000
+    poster.post({}, {'file': ('a.txt', content)})
+    poster.reply()
+    # the server lost it, the reference is answered with 409 and the request sent again in full
+    server.store.clear()
+    poster.post({'seq': '2'}, {'file': ('a.txt', content)})
+    assert poster.reply() == 'reply 3'
+    assert len(server.requests) == 3
+    assert len(server.requests[2]['raw']) > len(content)
+    assert server.requests[2]['parts'] == {'seq': b'2', 'file': content}
+
+def test_dedup_fallback_file_object(server):
+    poster = URLPoster.URLPoster(server.url)
+    poster.set_dedup(True)
+    content = b'y' * 10000
+    poster.post({}, {'file': ('a.txt', content)})
+    poster.reply()
+    server.store.clear()
+    # new content from a file object, which the first attempt reads to the end
+    other = io.BytesIO(b'h' * 1000 + b'w' * 5000)
+    other.seek(1000)
+    poster.post({}, {'file': ('a.txt', content), 'other': other})
+    assert poster.reply() == 'reply 3'
+    assert server.requests[2]['parts'] == {'file': content, 'other': b'w' * 5000}
+
+def test_gzip(server):
+    poster = URLPoster.URLPoster(server.url)
+    poster.set_compression(threshold=1024)
+    content = b'0123456789' * 1000
+    poster.post({}, {'file': ('a.txt', content)})
+    # the reply is compressed too
+    assert poster.reply() == 'reply 1'
+    req = server.requests[0]
+    assert req['headers']['Content-Encoding'] == 'gzip'
+    assert len(req['raw']) == int(req['headers']['Content-Length']) < len(content)
+    assert req['parts']['file'] == content
+    # small requests aren't compressed
+    poster.post({'seq': '2'}, {})
+    assert poster.reply() == 'reply 2'
+    assert server.requests[1]['headers']['Content-Encoding'] is None
+
+def test_gzip_dedup_fallback(server):
+    poster = URLPoster.URLPoster(server.url)
+    poster.set_compression(threshold=0)
+    poster.set_dedup(True)
+    content = io.BytesIO(b'z' * 5000)
+    poster.post({}, {'file': content})
+    poster.reply()
+    server.store.clear()
+    content.seek(0)
+    poster.post({}, {'file': content})
+    assert poster.reply() == 'reply 3'
+    assert server.requests[2]['parts']['file'] == b'z' * 5000